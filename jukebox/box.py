@@ -53,7 +53,7 @@ class Player:
         self.mixer = StreamMixer([], endless=True)
         self.output = Output(self.mixer.samplerate, self.mixer.samplewidth, self.mixer.nchannels, queuesize=self.async_buffers)
         self.mixed_samples = iter(self.mixer)
-        self.levelmeter = LevelMeter(rms_mode=False, lowest=self.levelmeter_lowest)
+        self.levelmeter = LevelMeter(rms_mode=False, lowest=self.levelmeter_lowest, decimation=4)
         self.output.register_notify_played(self.levelmeter.update)
         for tf in self.trackframes:
             tf.player = self
@@ -579,7 +579,7 @@ class EffectsFrame(ttk.LabelFrame):
     def set_effect(self, effect_nr, filename):
         try:
             with AudiofileToWavStream(filename, hqresample=hqresample) as wav:
-                sample = Sample(wav)
+                sample = Sample(wav).intern()    # identical effects share the sample data
                 self.effects[effect_nr] = sample
         except IOError as x:
             print("Can't load effect sample:", x)
@@ -85,7 +85,7 @@ class LevelGUI(tk.Frame):
         self.samplewidth = self.wave.getsampwidth()
         self.samplerate = self.wave.getframerate()
         self.nchannels = self.wave.getnchannels()
-        self.levelmeter = LevelMeter(rms_mode=False, lowest=self.lowest_level)
+        self.levelmeter = LevelMeter(rms_mode=False, lowest=self.lowest_level, decimation=4)
         self.audio_out = Output(self.samplerate, self.samplewidth, self.nchannels)
         print("Audio API used:", self.audio_out.audio_api)
         if not self.audio_out.supports_streaming:
@@ -324,7 +324,7 @@ def bells():
 def stereo_pan():
     synth = WaveSynth()
     # panning a stereo source:
-    wave = Sample("samples/SOS 020.wav").clip(6, 12).normalize().fadein(0.5).fadeout(0.5).lock()
+    wave = Sample("samples/SOS 020.wav").lazy().clip(6, 12).normalize().fadein(0.5).fadeout(0.5).lock()
     osc = Sine(0.4)
     panning = wave.copy().pan(lfo=osc).fadeout(0.2)
     with Output.for_sample(panning) as out:
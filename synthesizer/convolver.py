@@ -0,0 +1,129 @@
+"""
+Fast convolution of sample data with an impulse response, using FFT based partitioned overlap-add.
+This is used for echos (a sparse impulse response) and convolution reverb (a recorded impulse response).
+Requires numpy.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import numpy
+from .resampler import frames_to_array, array_to_frames
+
+
+__all__ = ["Convolver", "convolve", "reverb_kernel"]
+
+
+block_size = 4096       # maximum partition size (frames) of the impulse response
+batch_size = 1 << 18    # number of frames processed in one vectorized step
+sparse_taps = 32        # impulse responses with at most this many nonzero taps are convolved directly
+
+
+class Convolver:
+    """
+    Stateful convolution of raw sample frames with an impulse response, that you can feed in chunks.
+    The impulse response is an array of gain factors: one dimensional (applied to every channel),
+    or with one column per channel. It is split into equal sized partitions whose spectra are precomputed.
+    Every call to process() returns exactly as many frames as it was given (there is no latency),
+    call flush() at the end to obtain the remaining tail (the length of the impulse response minus one).
+    """
+    def __init__(self, impulse_response, samplewidth, nchannels):
+        ir = numpy.asarray(impulse_response, dtype=float)
+        if ir.ndim == 1:
+            ir = ir.reshape(-1, 1)
+        if len(ir) == 0 or ir.shape[1] not in (1, nchannels):
+            raise ValueError("impulse response must be nonempty and have 1 or nchannels columns")
+        self.samplewidth = samplewidth
+        self.nchannels = nchannels
+        self.taps = len(ir)
+        size = 256
+        while size < min(self.taps, block_size):
+            size *= 2
+        self.size = size
+        partitions = -(-self.taps // size)
+        ir = numpy.concatenate((ir, numpy.zeros((partitions*size-self.taps, ir.shape[1]))))
+        ir = ir.reshape(partitions, size, -1)
+        self.spectra = numpy.fft.rfft(ir, n=2*size, axis=1)
+        self._nonzero_partitions = numpy.flatnonzero(ir.any(axis=(1, 2)))   # silent partitions are skipped
+        self._history = numpy.zeros((partitions-1, size+1, nchannels), dtype=complex)
+        self._overlap = numpy.zeros((size, nchannels))
+        self._pending = numpy.zeros((0, nchannels))
+
+    def process(self, frames):
+        """Convolve a chunk of raw sample frames. Returns the same number of convolved frames."""
+        values = frames_to_array(frames, self.samplewidth, self.nchannels)
+        return array_to_frames(self._process(values), self.samplewidth)
+
+    def flush(self):
+        """Returns the remaining tail of the convolution, after the last input frames."""
+        return array_to_frames(self._process(numpy.zeros((self.taps-1, self.nchannels))), self.samplewidth)
+
+    def _process(self, values):
+        emitted = len(self._pending)
+        values = numpy.concatenate((self._pending, values))
+        complete = len(values) // self.size * self.size
+        results = [self._convolve_blocks(values[start:min(start+batch_size, complete)])
+                   for start in range(0, complete, batch_size)]
+        self._pending = values[complete:]
+        if len(self._pending):
+            # the incomplete last block is computed without updating the state, it is done again later
+            block = numpy.zeros((self.size, self.nchannels))
+            block[:len(self._pending)] = self._pending
+            results.append(self._convolve_blocks(block, False)[:len(self._pending)])
+        if results:
+            return numpy.concatenate(results)[emitted:]
+        return numpy.zeros((0, self.nchannels))
+
+    def _convolve_blocks(self, values, update_state=True):
+        nblocks = len(values) // self.size
+        spectra = numpy.fft.rfft(values.reshape(nblocks, self.size, self.nchannels), n=2*self.size, axis=1)
+        spectra = numpy.concatenate((self._history, spectra))
+        # frequency domain delay line: block k is convolved with partition p of the impulse response
+        partitions = len(self.spectra)
+        result = numpy.zeros((nblocks, self.size+1, self.nchannels), dtype=complex)
+        for p in self._nonzero_partitions:
+            result += spectra[partitions-1-p:partitions-1-p+nblocks] * self.spectra[p]
+        result = numpy.fft.irfft(result, n=2*self.size, axis=1)
+        output = result[:, :self.size].copy()
+        output[0] += self._overlap
+        output[1:] += result[:-1, self.size:]
+        if update_state:
+            self._history = spectra[len(spectra)-partitions+1:]
+            self._overlap = result[-1, self.size:]
+        return output.reshape(-1, self.nchannels)
+
+
+def convolve(frames, impulse_response, samplewidth, nchannels):
+    """
+    Convolves the raw sample frames with the impulse response in one go.
+    Returns the new frames, including the tail (the length of the impulse response minus one).
+    A sparse impulse response (such as a series of echos) is convolved directly, which is faster for that case.
+    """
+    ir = numpy.asarray(impulse_response, dtype=float)
+    if ir.ndim == 1 and 0 < numpy.count_nonzero(ir) <= sparse_taps:
+        values = frames_to_array(frames, samplewidth, nchannels)
+        result = numpy.zeros((len(values)+len(ir)-1, nchannels))
+        for tap in numpy.flatnonzero(ir):
+            result[tap:tap+len(values)] += ir[tap] * values
+        return array_to_frames(result, samplewidth)
+    convolver = Convolver(ir, samplewidth, nchannels)
+    return convolver.process(frames) + convolver.flush()
+
+
+def reverb_kernel(impulse, samplerate, nchannels, wet=0.5, dry=1.0):
+    """
+    Creates the convolution kernel for a reverb from an impulse response Sample (such as a recorded room response).
+    It is converted to the given sample rate and normalized to unit energy,
+    and the dry signal is added on the first tap.
+    A mono impulse response is used for all channels.
+    """
+    ir = impulse.copy()
+    if ir.samplerate != samplerate:
+        ir.resample(samplerate)
+    values = frames_to_array(ir.view_frame_data(), ir.samplewidth, ir.nchannels)
+    if ir.nchannels != nchannels:
+        values = values.mean(axis=1, keepdims=True)
+    energy = numpy.sqrt((values**2).sum(axis=0).max())
+    if energy > 0:
+        values *= wet / energy
+    values[0] += dry
+    return values
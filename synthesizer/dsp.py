@@ -0,0 +1,544 @@
+"""
+Low level digital signal processing primitives that operate on raw sample fragments
+(bytes of little-endian signed integer samples), as used by the Sample class.
+
+This is a small pluggable backend layer. It provides the functions of the audioop module
+that this project needs, because audioop was deprecated and removed from the standard
+library in Python 3.13. Supported backends:
+- numpy (vectorized, preferred)
+- audioop (only available on Python versions before 3.13)
+The best available backend is selected automatically, but you can switch with use_backend().
+
+For vectorized processing of the sample values, there are also functions to unpack fragments into numpy arrays
+(and pack them back again), including fast conversion of packed 24 bit samples. These always require numpy.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import math
+import itertools
+
+__all__ = ["DspBackendNotAvailableError", "NumpyBackend", "AudioopBackend", "best_backend", "use_backend",
+           "add", "mul", "lin2lin", "ratecv", "tomono", "tostereo", "remix", "rms", "max", "levels", "minmax", "bias",
+           "byteswap", "reverse", "getsample", "gain", "unpack", "pack", "unpack_float", "pack_float"]
+
+
+# stubs for the optional backend library modules:
+numpy = None
+audioop = None
+
+
+class DspBackendNotAvailableError(Exception):
+    pass
+
+
+def best_backend():
+    try:
+        return NumpyBackend()
+    except ImportError:
+        try:
+            return AudioopBackend()
+        except ImportError:
+            raise DspBackendNotAvailableError("no suitable dsp backend available (install numpy)") from None
+
+
+def use_backend(new_backend):
+    """Switch to another dsp backend (instance). Returns the backend that was active before."""
+    global backend
+    previous = backend
+    backend = new_backend
+    return previous
+
+
+class DspBackend:
+    def __str__(self):
+        return self.__class__.__name__
+
+    def add(self, fragment1, fragment2, width):
+        """Add two fragments sample by sample, clipping values that overflow the sample width."""
+        raise NotImplementedError
+
+    def mul(self, fragment, width, factor):
+        """Multiply all samples by the factor, clipping values that overflow the sample width."""
+        raise NotImplementedError
+
+    def lin2lin(self, fragment, width, newwidth):
+        """Convert samples to another sample width."""
+        raise NotImplementedError
+
+    def ratecv(self, fragment, width, nchannels, inrate, outrate, state, weightA=1, weightB=0):
+        """Convert the frame rate. Returns tuple (newfragment, newstate), like audioop.ratecv."""
+        raise NotImplementedError
+
+    def tomono(self, fragment, width, lfactor, rfactor):
+        """Convert a stereo fragment to mono, mixing the channels using the given factors."""
+        raise NotImplementedError
+
+    def tostereo(self, fragment, width, lfactor, rfactor):
+        """Convert a mono fragment to stereo, using the given factors for the left and right channel."""
+        raise NotImplementedError
+
+    def remix(self, fragment, width, nchannels, matrix):
+        """
+        Mix the channels of the frames with a channel matrix, that has a row for every output channel
+        containing the factor of every input channel. This generalizes tomono and tostereo
+        (and gives identical results for those): it can route, up-mix or down-mix any number of channels.
+        Values that overflow the sample width are clipped.
+        """
+        raise NotImplementedError
+
+    def rms(self, fragment, width):
+        """Root-mean-square of the samples."""
+        raise NotImplementedError
+
+    def max(self, fragment, width):
+        """Maximum absolute value of the samples."""
+        raise NotImplementedError
+
+    def levels(self, fragment, width, nchannels, decimation=1):
+        """
+        Returns the peak (maximum absolute) values and the rms values of every channel, as two lists.
+        They're computed directly on the interleaved frames. With decimation only every n-th frame
+        is examined, which is a lot faster and usually accurate enough for a level meter.
+        """
+        raise NotImplementedError
+
+    def minmax(self, fragment, width, nchannels, frames_per_bin):
+        """
+        Returns the minimum and maximum values of every channel per bin of the given number of frames
+        (a short history to display a waveform): a list with a list of (min, max) tuples for every channel.
+        """
+        raise NotImplementedError
+
+    def bias(self, fragment, width, bias):
+        """Add the bias to all samples (values wrap around on overflow)."""
+        raise NotImplementedError
+
+    def byteswap(self, fragment, width):
+        """Convert big-endian samples to little-endian and vice versa."""
+        raise NotImplementedError
+
+    def reverse(self, fragment, width):
+        """Reverse the samples."""
+        raise NotImplementedError
+
+    def getsample(self, fragment, width, index):
+        """Return the value of the sample with the given index."""
+        raise NotImplementedError
+
+    def gain(self, fragment, width, nchannels, gains):
+        """
+        Multiply the frames with the given gain curve. It contains one gain value per frame,
+        or a sequence of gain values per frame with a separate gain for every channel.
+        The number of gain values determines the number of frames processed.
+        Values that overflow the sample width are clipped.
+        """
+        raise NotImplementedError
+
+
+class AudioopBackend(DspBackend):
+    """Backend that uses the audioop module from the standard library (removed in Python 3.13)"""
+    def __init__(self):
+        global audioop
+        import audioop
+
+    def add(self, fragment1, fragment2, width):
+        return audioop.add(fragment1, fragment2, width)
+
+    def mul(self, fragment, width, factor):
+        return audioop.mul(fragment, width, factor)
+
+    def lin2lin(self, fragment, width, newwidth):
+        return audioop.lin2lin(fragment, width, newwidth)
+
+    def ratecv(self, fragment, width, nchannels, inrate, outrate, state, weightA=1, weightB=0):
+        return audioop.ratecv(fragment, width, nchannels, inrate, outrate, state, weightA, weightB)
+
+    def tomono(self, fragment, width, lfactor, rfactor):
+        return audioop.tomono(fragment, width, lfactor, rfactor)
+
+    def tostereo(self, fragment, width, lfactor, rfactor):
+        return audioop.tostereo(fragment, width, lfactor, rfactor)
+
+    def remix(self, fragment, width, nchannels, matrix):
+        matrix = [list(row) for row in matrix]
+        assert all(len(row) == nchannels for row in matrix)
+        if nchannels == 1 and len(matrix) == 2:
+            return audioop.tostereo(fragment, width, matrix[0][0], matrix[1][0])
+        if nchannels == 2 and len(matrix) == 1:
+            return audioop.tomono(fragment, width, *matrix[0])
+        if nchannels == 2 and len(matrix) == 2:
+            left = audioop.tostereo(audioop.tomono(fragment, width, *matrix[0]), width, 1, 0)
+            right = audioop.tostereo(audioop.tomono(fragment, width, *matrix[1]), width, 0, 1)
+            return audioop.add(left, right, width)
+        _getsample = audioop.getsample   # optimization
+        maxvalue = 2**(8*width-1)
+        result = []
+        for frame in range(len(fragment) // width // nchannels):
+            values = [_getsample(fragment, width, frame*nchannels+channel) for channel in range(nchannels)]
+            for row in matrix:
+                v = math.floor(sum(factor*value for factor, value in zip(row, values)))
+                result.append(min(maxvalue-1, v if v > -maxvalue else -maxvalue).to_bytes(width, "little", signed=True))
+        return b"".join(result)
+
+    def rms(self, fragment, width):
+        return audioop.rms(fragment, width)
+
+    def max(self, fragment, width):
+        return audioop.max(fragment, width)
+
+    def levels(self, fragment, width, nchannels, decimation=1):
+        if width == 3:
+            # the 24 bits values are shifted into 32 bits, the results can be shifted back exactly
+            peaks, rms = self.levels(audioop.lin2lin(fragment, 3, 4), 4, nchannels, decimation)
+            return [peak >> 8 for peak in peaks], [value >> 8 for value in rms]
+        channels = [self._channel(fragment, width, nchannels, channel, decimation) for channel in range(nchannels)]
+        return [audioop.max(values, width) for values in channels], [audioop.rms(values, width) for values in channels]
+
+    def minmax(self, fragment, width, nchannels, frames_per_bin):
+        if width == 3:
+            result = self.minmax(audioop.lin2lin(fragment, 3, 4), 4, nchannels, frames_per_bin)
+            return [[(low >> 8, high >> 8) for low, high in bins] for bins in result]
+        result = []
+        for channel in range(nchannels):
+            values = self._channel(fragment, width, nchannels, channel)
+            size = frames_per_bin * width
+            result.append([audioop.minmax(values[i:i+size], width) for i in range(0, len(values), size)])
+        return result
+
+    def _channel(self, fragment, width, nchannels, channel, step=1):
+        # the samples of one channel (of every step-th frame), taken from a strided view on the fragment
+        if nchannels == step == 1:
+            return fragment
+        values = memoryview(fragment).cast("B").cast({1: "b", 2: "h", 4: "i"}[width])
+        return values[channel::nchannels*step].tobytes()
+
+    def bias(self, fragment, width, bias):
+        return audioop.bias(fragment, width, bias)
+
+    def byteswap(self, fragment, width):
+        return audioop.byteswap(fragment, width)
+
+    def reverse(self, fragment, width):
+        return audioop.reverse(fragment, width)
+
+    def getsample(self, fragment, width, index):
+        return audioop.getsample(fragment, width, index)
+
+    def gain(self, fragment, width, nchannels, gains):
+        if len(gains) and hasattr(gains[0], "__len__"):
+            gains = itertools.chain.from_iterable(gains)
+        else:
+            gains = itertools.chain.from_iterable(itertools.repeat(g, nchannels) for g in gains)
+        _getsample = audioop.getsample   # optimization
+        maxvalue = 2**(8*width-1)
+        values = [int(_getsample(fragment, width, i)*g) for i, g in enumerate(gains)]
+        return b"".join(min(maxvalue-1, v if v > -maxvalue else -maxvalue).to_bytes(width, "little", signed=True)
+                        for v in values)
+
+
+class NumpyBackend(DspBackend):
+    """
+    Backend that uses numpy to process the samples, this works on all Python versions.
+    The results are identical to those of audioop, except for the rms value which can
+    differ slightly due to a different summation order.
+    """
+    def __init__(self):
+        global numpy
+        import numpy
+
+    # the sample value dtypes per sample width, and the wider dtypes used for intermediate results
+    _dtypes = {1: "<i1", 2: "<i2", 4: "<i4"}
+    _wide_dtypes = {1: "<i2", 2: "<i4", 3: "<i8", 4: "<i8"}
+
+    def _values(self, fragment, width):
+        """Returns the samples in the fragment as numpy integer array (24 bits samples are unpacked to 32 bits)."""
+        if width == 3:
+            # put the 3 bytes in the upper part of a 32 bit integer, the arithmetic shift does the sign extension
+            raw = numpy.frombuffer(fragment, dtype=numpy.uint8).reshape(-1, 3)
+            padded = numpy.zeros((len(raw), 4), dtype=numpy.uint8)
+            padded[:, 1:] = raw
+            values = padded.view("<i4").reshape(-1)
+            values >>= 8
+            return values
+        return numpy.frombuffer(fragment, dtype=self._dtypes[width])
+
+    def _fragment(self, values, width):
+        """Returns the raw fragment (bytes) for the given array of sample values, that must fit in the width."""
+        if width == 3:
+            raw = numpy.ascontiguousarray(values, dtype="<i4").view(numpy.uint8).reshape(-1, 4)
+            return raw[:, :3].tobytes()
+        return values.astype(self._dtypes[width]).tobytes()
+
+    def _clip(self, values, width):
+        """Clips the values (in place) to the range of the sample width."""
+        maxvalue = 2**(8*width-1)
+        return numpy.clip(values, -maxvalue, maxvalue-1, out=values)
+
+    def add(self, fragment1, fragment2, width):
+        if len(fragment1) != len(fragment2):
+            raise ValueError("lengths should be the same")
+        values = self._values(fragment1, width).astype(self._wide_dtypes[width])
+        values += self._values(fragment2, width)
+        return self._fragment(self._clip(values, width), width)
+
+    def mul(self, fragment, width, factor):
+        values = self._values(fragment, width) * float(factor)
+        return self._fragment(self._clip(numpy.floor(values, out=values), width), width)
+
+    def lin2lin(self, fragment, width, newwidth):
+        if width == newwidth:
+            return bytes(fragment)
+        # For little-endian samples this is just moving bytes around: widening adds zero bytes
+        # at the low end, narrowing drops the lowest bytes (the same as an arithmetic shift).
+        raw = numpy.frombuffer(fragment, dtype=numpy.uint8).reshape(-1, width)
+        result = numpy.zeros((len(raw), newwidth), dtype=numpy.uint8)
+        if newwidth > width:
+            result[:, newwidth-width:] = raw
+        else:
+            result[:] = raw[:, width-newwidth:]
+        return result.tobytes()
+
+    def ratecv(self, fragment, width, nchannels, inrate, outrate, state, weightA=1, weightB=0):
+        # This is a vectorized version of the linear interpolation algorithm that audioop uses.
+        # It computes for every output frame which input frame it is interpolated from, and the weight.
+        if inrate <= 0 or outrate <= 0:
+            raise ValueError("sampling rate not > 0")
+        if weightA < 1 or weightB < 0:
+            raise ValueError("weightA should be >= 1, weightB should be >= 0")
+        d = math.gcd(inrate, outrate)
+        inrate //= d
+        outrate //= d
+        d = math.gcd(weightA, weightB)
+        weightA //= d
+        weightB //= d
+        if state is None:
+            d = -outrate
+            prev_state = cur_state = numpy.zeros(nchannels, dtype=numpy.int64)
+        else:
+            d, samps = state
+            if len(samps) != nchannels:
+                raise ValueError("illegal state argument")
+            prev_state = numpy.array([prev for prev, cur in samps], dtype=numpy.int64)
+            cur_state = numpy.array([cur for prev, cur in samps], dtype=numpy.int64)
+        current = self._values(fragment, width).astype(numpy.int64).reshape(-1, nchannels) << (32-8*width)
+        if weightB:
+            # simple digital filter, this is a recurrence so it can't be vectorized
+            filtered = current.astype(float)
+            previous = cur_state.astype(float)
+            for i in range(len(filtered)):
+                filtered[i] = numpy.trunc((weightA*filtered[i] + weightB*previous) / (weightA+weightB))
+                previous = filtered[i]
+            current = filtered.astype(numpy.int64)
+        num_in = len(current)
+        if num_in == 0:
+            return b"", (d, tuple(zip(prev_state.tolist(), cur_state.tolist())))
+        previous = numpy.concatenate((cur_state.reshape(1, nchannels), current[:-1]))
+        available = num_in*outrate + d
+        num_out = available//inrate + 1 if available >= 0 else 0
+        j = numpy.arange(num_out, dtype=numpy.int64)
+        consumed = -((d - j*inrate) // outrate)      # ceil((j*inrate-d)/outrate): input frames consumed for output j
+        weights = (d + consumed*outrate - j*inrate).reshape(-1, 1)
+        k = consumed-1
+        out = numpy.trunc((previous[k]*weights.astype(float) + current[k]*(outrate-weights).astype(float)) / outrate)
+        out = out.astype(numpy.int64) >> (32-8*width)
+        d += num_in*outrate - num_out*inrate
+        new_prev = previous[-1]
+        new_cur = current[-1]
+        return self._fragment(out.reshape(-1), width), (int(d), tuple(zip(new_prev.tolist(), new_cur.tolist())))
+
+    def tomono(self, fragment, width, lfactor, rfactor):
+        values = self._values(fragment, width).reshape(-1, 2)
+        if (lfactor, rfactor) in ((1, 0), (0, 1)):
+            return self._fragment(values[:, 0 if lfactor else 1], width)
+        mono = values[:, 0] * float(lfactor)
+        mono += values[:, 1] * float(rfactor)
+        return self._fragment(self._clip(numpy.floor(mono, out=mono), width), width)
+
+    def tostereo(self, fragment, width, lfactor, rfactor):
+        values = self._values(fragment, width)
+        if lfactor == rfactor == 1:
+            return self._fragment(numpy.repeat(values, 2), width)
+        stereo = numpy.empty((len(values), 2))
+        numpy.multiply(values, float(lfactor), out=stereo[:, 0])
+        numpy.multiply(values, float(rfactor), out=stereo[:, 1])
+        return self._fragment(self._clip(numpy.floor(stereo, out=stereo), width), width)
+
+    def remix(self, fragment, width, nchannels, matrix):
+        matrix = numpy.asarray(matrix, dtype=float).reshape(-1, nchannels)
+        values = self._values(fragment, width).reshape(-1, nchannels)
+        if ((matrix == 0) | (matrix == 1)).all() and (matrix.sum(axis=1) == 1).all():
+            # every output channel is a copy of an input channel, so no arithmetic is needed
+            return self._fragment(values[:, matrix.argmax(axis=1)], width)
+        # accumulate channel by channel (rather than a matrix product) to get the same rounding as audioop
+        result = values[:, :1] * matrix[:, 0]
+        for channel in range(1, nchannels):
+            result += values[:, channel:channel+1] * matrix[:, channel]
+        return self._fragment(self._clip(numpy.floor(result, out=result), width), width)
+
+    def rms(self, fragment, width):
+        values = self._values(fragment, width)
+        if len(values) == 0:
+            return 0
+        return int(math.sqrt(numpy.einsum("i,i->", values, values, dtype=float) / len(values)))
+
+    def max(self, fragment, width):
+        values = self._values(fragment, width)
+        if len(values) == 0:
+            return 0
+        highest, lowest = int(values.max()), int(values.min())
+        return highest if highest >= -lowest else -lowest
+
+    def levels(self, fragment, width, nchannels, decimation=1):
+        values = self._values(fragment, width).reshape(-1, nchannels)[::decimation]
+        if len(values) == 0:
+            return [0] * nchannels, [0] * nchannels
+        peaks, rms = [], []
+        # reducing the strided channel views one by one is much faster than reducing along the frames axis
+        for channel in values.T:
+            highest, lowest = int(channel.max()), int(channel.min())
+            peaks.append(highest if highest >= -lowest else -lowest)
+            channel = channel.astype(float)
+            rms.append(int(math.sqrt(numpy.dot(channel, channel) / len(channel))))
+        return peaks, rms
+
+    def minmax(self, fragment, width, nchannels, frames_per_bin):
+        values = self._values(fragment, width).reshape(-1, nchannels)
+        if len(values) == 0:
+            return [[] for _ in range(nchannels)]
+        starts = numpy.arange(0, len(values), frames_per_bin)
+        return [list(zip(numpy.minimum.reduceat(channel, starts).tolist(),
+                         numpy.maximum.reduceat(channel, starts).tolist()))
+                for channel in values.T]
+
+    def bias(self, fragment, width, bias):
+        values = self._values(fragment, width).astype(numpy.int64) + int(bias)
+        maxvalue = 2**(8*width-1)
+        return self._fragment((values + maxvalue) % (2*maxvalue) - maxvalue, width)
+
+    def byteswap(self, fragment, width):
+        raw = numpy.frombuffer(fragment, dtype=numpy.uint8).reshape(-1, width)
+        return raw[:, ::-1].tobytes()
+
+    def reverse(self, fragment, width):
+        return self._fragment(self._values(fragment, width)[::-1], width)
+
+    def getsample(self, fragment, width, index):
+        if not 0 <= index < len(fragment)//width:
+            raise IndexError("index out of range")
+        return int(self._values(fragment[index*width:(index+1)*width], width)[0])
+
+    def gain(self, fragment, width, nchannels, gains):
+        gains = numpy.asarray(gains, dtype=float)
+        num_frames = len(gains)
+        values = self._values(memoryview(fragment)[:num_frames*nchannels*width], width).reshape(-1, nchannels)
+        values = values * gains.reshape(num_frames, -1)
+        return self._fragment(self._clip(values, width), width)
+
+
+# the dsp functions operate on the currently active backend:
+
+def add(fragment1, fragment2, width):
+    return backend.add(fragment1, fragment2, width)
+
+
+def mul(fragment, width, factor):
+    return backend.mul(fragment, width, factor)
+
+
+def lin2lin(fragment, width, newwidth):
+    return backend.lin2lin(fragment, width, newwidth)
+
+
+def ratecv(fragment, width, nchannels, inrate, outrate, state, weightA=1, weightB=0):
+    return backend.ratecv(fragment, width, nchannels, inrate, outrate, state, weightA, weightB)
+
+
+def tomono(fragment, width, lfactor, rfactor):
+    return backend.tomono(fragment, width, lfactor, rfactor)
+
+
+def tostereo(fragment, width, lfactor, rfactor):
+    return backend.tostereo(fragment, width, lfactor, rfactor)
+
+
+def remix(fragment, width, nchannels, matrix):
+    return backend.remix(fragment, width, nchannels, matrix)
+
+
+def rms(fragment, width):
+    return backend.rms(fragment, width)
+
+
+def max(fragment, width):
+    return backend.max(fragment, width)
+
+
+def levels(fragment, width, nchannels, decimation=1):
+    return backend.levels(fragment, width, nchannels, decimation)
+
+
+def minmax(fragment, width, nchannels, frames_per_bin):
+    return backend.minmax(fragment, width, nchannels, frames_per_bin)
+
+
+def bias(fragment, width, bias):
+    return backend.bias(fragment, width, bias)
+
+
+def byteswap(fragment, width):
+    return backend.byteswap(fragment, width)
+
+
+def reverse(fragment, width):
+    return backend.reverse(fragment, width)
+
+
+def getsample(fragment, width, index):
+    return backend.getsample(fragment, width, index)
+
+
+def gain(fragment, width, nchannels, gains):
+    return backend.gain(fragment, width, nchannels, gains)
+
+
+def _numpy_backend():
+    if isinstance(backend, NumpyBackend):
+        return backend
+    try:
+        return NumpyBackend()
+    except ImportError:
+        raise DspBackendNotAvailableError("this requires numpy") from None
+
+
+def unpack(fragment, width):
+    """
+    Returns the samples in the fragment as numpy integer array. For sample widths 1, 2 and 4 this is a
+    read-only view on the fragment without copying, packed 24 bit samples are unpacked into 32 bit integers.
+    """
+    return _numpy_backend()._values(fragment, width)
+
+
+def pack(values, width):
+    """Returns the fragment for the numpy array of integer sample values (that must fit in the sample width)."""
+    return _numpy_backend()._fragment(values, width)
+
+
+def unpack_float(fragment, width):
+    """
+    Returns the samples in the fragment as numpy float32 array, scaled to the range -1.0 to 1.0.
+    Samples of up to 24 bits are represented exactly.
+    """
+    values = _numpy_backend()._values(fragment, width).astype(numpy.float32)
+    values *= numpy.float32(1.0/2**(8*width-1))
+    return values
+
+
+def pack_float(values, width):
+    """Returns the fragment for the numpy array of float sample values (-1.0 to 1.0), rounded and clipped."""
+    nb = _numpy_backend()
+    values = numpy.rint(numpy.asarray(values, dtype=numpy.float64) * 2**(8*width-1))
+    return nb._fragment(nb._clip(values, width), width)
+
+
+backend = best_backend()
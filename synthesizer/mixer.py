@@ -9,18 +9,243 @@ Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
 
 import os
 import cmd
+import json
+import array
+import fractions
+import collections
+import concurrent.futures
+from multiprocessing import shared_memory
 from configparser import ConfigParser
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from . import dsp
 from .sample import Sample
+from .samplecache import SampleCache
 from .playback import Output
 
-__all__ = ["Mixer", "Song", "Repl"]
+__all__ = ["Mixer", "Timeline", "Sequencer", "RenderCache", "Song", "Repl", "pattern_triggers", "trigger_gains"]
+
+
+class RenderCache:
+    """
+    Cache for rendered sample data (Samples or numpy arrays), with a size budget in bytes.
+    When the budget is exceeded, the least recently used entries are discarded.
+    The keys should identify the content, for instance by using sample fingerprints, so that
+    the cache can be shared by different mixers. Keeps hit and miss statistics.
+    """
+    def __init__(self, max_bytes=128*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()     # key -> (value, size in bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Returns the cached value (and marks it as recently used), or the default value if it's not in the cache."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        size = value.nbytes if hasattr(value, "nbytes") else value.view_frame_data().nbytes
+        if key in self._entries:
+            del self[key]
+        if size > self.max_bytes:
+            return      # too large to cache at all
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def __delitem__(self, key):
+        self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """Returns the cache statistics: number of entries, size in bytes, hits, misses and the hit rate."""
+        lookups = self.hits + self.misses
+        return {"entries": len(self), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class Timeline:
+    """
+    The compiled form of a song: a flat table of all the instrument trigger events, in chronological order.
+    The events are stored in arrays: the start frame, the instrument id (index in the samples list), the gain,
+    and the number of frames after which the voice is cut off with a short fade out (-1 if it plays completely,
+    see voice_values). Length is the total number of frames of the mix.
+    The sections are the occurrences of the patterns: (start frame, pattern key, first event, end event).
+    Sections with the same key contain the same events (relative to their start), so they sound the same.
+    """
+    def __init__(self, samples, length):
+        self.samples = samples
+        self.length = length
+        self.frames = array.array("q")
+        self.instruments = array.array("I")
+        self.gains = array.array("d")
+        self.lengths = array.array("q")
+        self.sections = []
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, frame, instrument, gain=1.0, length=-1):
+        """Add a trigger event for the instrument (id) at the given frame."""
+        self.frames.append(frame)
+        self.instruments.append(instrument)
+        self.gains.append(gain)
+        self.lengths.append(length)
+
+    def add_events(self, frames, instruments, gains):
+        """Add many trigger events at once (the arguments are sequences or numpy arrays of equal length)."""
+        if numpy:
+            self.frames.frombytes(numpy.asarray(frames, dtype=numpy.int64).tobytes())
+            self.instruments.frombytes(numpy.asarray(instruments, dtype=numpy.uint32).tobytes())
+            self.gains.frombytes(numpy.asarray(gains, dtype=numpy.float64).tobytes())
+        else:
+            self.frames.extend(frames)
+            self.instruments.extend(instruments)
+            self.gains.extend(gains)
+        self.lengths.extend([-1] * (len(self.frames) - len(self.lengths)))
+
+    def voice_length(self, event):
+        """Returns the number of frames that the voice of the event sounds."""
+        length = len(self.samples[self.instruments[event]])
+        if self.lengths[event] >= 0:
+            return min(length, self.lengths[event] + _fade_frames())
+        return length
+
+    def section(self, index):
+        """
+        Returns a new Timeline with just the events of the given section, relative to the start of the section.
+        Its length includes the tail: the sound of the last events that extends beyond the end of the section.
+        """
+        start, _, first_event, end_event = self.sections[index]
+        section = Timeline(self.samples, 0)
+        for event in range(first_event, end_event):
+            section.add(self.frames[event] - start, self.instruments[event], self.gains[event], self.lengths[event])
+            section.length = max(section.length, self.frames[event] - start + self.voice_length(event))
+        return section
+
+    def peak_level(self):
+        """
+        Returns an upper bound of the absolute sample value that the sum of the events can reach:
+        the highest peak level of the instruments times the largest number of events that overlap. Requires numpy.
+        """
+        if not self.frames:
+            return 0
+        lengths = numpy.array([len(sample) for sample in self.samples], dtype=numpy.int64)
+        peak = max(dsp.max(sample.view_frame_data(), sample.samplewidth) for sample in self.samples)
+        starts = numpy.frombuffer(self.frames, dtype=numpy.int64)
+        ends = starts + lengths[numpy.frombuffer(self.instruments, dtype=numpy.uint32)]
+        # count the events that are sounding at every start or end position (ends are sorted before starts)
+        positions = numpy.concatenate((ends*2, starts*2+1))
+        changes = numpy.concatenate((numpy.full(len(ends), -1), numpy.ones(len(starts), dtype=int)))
+        overlap = numpy.cumsum(changes[numpy.argsort(positions, kind="stable")]).max()
+        return peak * max(abs(gain) for gain in self.gains) * overlap
+
+
+def pattern_triggers(pattern):
+    """
+    Returns the triggers in the pattern (a dict of instrument name to bars): the tick indexes, the rows
+    (index of the instrument in the pattern) and the trigger characters, ordered by tick and then by row.
+    A trigger is any character other than '.' or a space. With numpy, these are arrays found with nonzero()
+    on the matrix of the bar characters.
+    """
+    if numpy:
+        chars = numpy.array([numpy.frombuffer(bars.encode("utf-32-le"), dtype="<u4") for bars in pattern.values()])
+        triggered = (chars != ord(".")) & (chars != ord(" "))
+        ticks, rows = numpy.nonzero(triggered.T)
+        return ticks, rows, chars[rows, ticks]
+    all_bars = list(pattern.values())
+    triggers = [(tick, row) for tick in range(len(all_bars[0]))
+                for row, bars in enumerate(all_bars) if bars[tick] not in ". "]
+    return [t for t, _ in triggers], [r for _, r in triggers], [ord(all_bars[r][t]) for t, r in triggers]
+
+
+accent_gain = 1.4       # level of accented triggers, about 3 dB louder
+
+
+def trigger_gains(chars):
+    """
+    Returns the gains of the trigger characters (character codes, as returned by pattern_triggers).
+    The digits 1-9 are velocity levels from soft to full: 1/9 up to 9/9 of the level of the sample.
+    'X' is an accent, played at accent_gain. Any other character (such as 'x') is a normal trigger at full level.
+    """
+    if numpy:
+        chars = numpy.asarray(chars)
+        gains = numpy.ones(len(chars))
+        digits = (chars >= ord("1")) & (chars <= ord("9"))
+        gains[digits] = (chars[digits] - ord("0")) / 9
+        gains[chars == ord("X")] = accent_gain
+        return gains
+    return [(char - ord("0")) / 9 if ord("1") <= char <= ord("9") else accent_gain if char == ord("X") else 1.0
+            for char in chars]
+
+
+choke_fade_seconds = 0.005     # fade out of voices that are cut off by a choke group or voice limit
+
+
+def _fade_frames():
+    return max(1, int(Sample.norm_samplerate * choke_fade_seconds))
+
+
+def voice_values(sample, gain=1.0, length=-1):
+    """
+    Returns the sound of a voice of the (32 bits) instrument sample: with numpy the sample values (int64 array
+    of frames x channels), otherwise the raw sample frames. The sample is scaled by the gain, and if the length
+    isn't -1, it's cut off after that many frames with a short linear fade out (of choke_fade_seconds).
+    """
+    fade = _fade_frames()
+    if numpy:
+        values = dsp.unpack(sample.view_frame_data(), 4).reshape(-1, sample.nchannels)
+        if gain != 1.0:
+            values = numpy.rint(values * gain).astype(numpy.int64)
+        if 0 <= length < len(values):
+            values = values[:length+fade].copy()
+            ramp = numpy.arange(fade, 0, -1)[:len(values)-length] / (fade + 1)
+            values[length:] = numpy.rint(values[length:] * ramp.reshape(-1, 1))
+        return values
+    fragment = sample.view_frame_data()
+    if gain != 1.0:
+        fragment = dsp.mul(fragment, 4, gain)
+    if 0 <= length < len(sample):
+        frame_size = 4 * sample.nchannels
+        faded = bytearray(fragment[:length*frame_size])
+        for frame in range(length, min(length + fade, len(sample))):
+            faded += dsp.mul(fragment[frame*frame_size:(frame+1)*frame_size], 4, (fade + length - frame) / (fade + 1))
+        fragment = bytes(faded)
+    return fragment
 
 
 class Mixer:
     """
     Mixes a set of ascii-bar tracks using the given sample instruments, into a resulting big sample.
+    Choke_groups maps instrument names to the name of their choke group: a trigger of an instrument in a group
+    cuts off the voices of all instruments in the group (itself included) that started before it
+    (like an open hihat that is choked by the closed hihat). Voice_limits maps instrument names to the maximum
+    number of voices of that instrument that can sound at the same time; for a new trigger above the limit,
+    the oldest voice is stolen.
+    Voices that are cut off get a short fade out instead of ending with a click.
     """
-    def __init__(self, patterns, bpm, ticks, instruments):
+    block_frames = 1 << 18      # size of the blocks that are rendered at once
+
+    def __init__(self, patterns, bpm, ticks, instruments, pattern_cache=None, mix_cache=None,
+                 choke_groups=None, voice_limits=None):
         for p in patterns:
             bar_length = 0
             for instrument, bars in p.items():
@@ -35,85 +260,269 @@ class Mixer:
         self.instruments = instruments
         self.bpm = bpm
         self.ticks = ticks
+        self.pattern_cache = pattern_cache     # pattern key -> rendered pattern, a RenderCache can be shared by mixers
+        self.mix_cache = RenderCache() if mix_cache is None else mix_cache   # instrument combination -> mixed sample
+        self.choke_groups = choke_groups or {}
+        self.voice_limits = voice_limits or {}
+        for limit in self.voice_limits.values():
+            if limit < 1:
+                raise ValueError("voice limit must be at least 1")
 
-    def mix(self, verbose=True):
+    def mix(self, verbose=True, workers=1):
         """
         Mix all the patterns into a single result sample.
+        With more than one worker, the mix is split into time segments that are rendered in parallel
+        by that many worker processes. The result is exactly the same as with a single worker.
         """
         if not self.patterns:
             if verbose:
                 print("No patterns to mix, output is empty.")
             return Sample()
-        total_seconds = 0.0
-        for p in self.patterns:
-            bar = next(iter(p.values()))
-            total_seconds += len(bar) * 60.0 / self.bpm / self.ticks
         if verbose:
             print("Mixing {:d} patterns...".format(len(self.patterns)))
-        mixed = Sample().make_32bit()
-        for index, timestamp, sample in self.mixed_samples(tracker=False):
-            if verbose:
-                print("\r{:3.0f} % ".format(timestamp/total_seconds*100), end="")
-            mixed.mix_at(timestamp, sample)
-        # chop/extend to get to the precise total duration (in case of silence in the last bars etc)
-        missing = total_seconds-mixed.duration
-        if missing > 0:
-            mixed.add_silence(missing)
-        elif missing < 0:
-            mixed.clip(0, total_seconds)
+        timeline = self.compile()
+        if workers > 1:
+            frames = self.render_parallel(timeline, workers)
+        else:
+            frames = self.render(timeline)
+        mixed = Sample.from_raw_frames(frames, 4, Sample.norm_samplerate, Sample.norm_nchannels)
         if verbose:
-            print("\rMix done.")
+            print("Mix done.")
         return mixed
 
-    def mix_generator(self):
+    def render_changes(self, timeline, previous_timeline, previous_frames):
+        """
+        Renders the timeline by updating the frames that were rendered before for the previous timeline
+        (the same song, before it was edited). Only the part from the first to the last section that differs,
+        plus the tail that rings out after it, is rendered again. The rest of the previous frames is reused.
+        Returns the new frames. If the length of the song didn't change, the previous frames are updated in place.
+        """
+        frame_size = 4 * Sample.norm_nchannels
+        old, new = previous_timeline.sections, timeline.sections
+        same_start = 0
+        while same_start < min(len(old), len(new)) and old[same_start][:2] == new[same_start][:2]:
+            same_start += 1
+        same_end = 0    # the sections at the end are compared by their position relative to the end of the song
+        while same_end < min(len(old), len(new)) - same_start and \
+                (previous_timeline.length - old[-1-same_end][0], old[-1-same_end][1]) == \
+                (timeline.length - new[-1-same_end][0], new[-1-same_end][1]):
+            same_end += 1
+        if same_start == len(old) == len(new) and previous_timeline.length == timeline.length:
+            return previous_frames
+        start = new[same_start][0] if same_start < len(new) else timeline.length
+        changed_end = new[len(new)-same_end][0] if same_end else timeline.length
+        longest = max(len(sample) for sample in timeline.samples + previous_timeline.samples)
+        end = min(changed_end + longest, timeline.length)
+        previous_end = end - timeline.length + previous_timeline.length
+        rendered = self.render(timeline, start, end)
+        if previous_timeline.length == timeline.length:
+            previous_frames[start*frame_size:end*frame_size] = rendered
+            return previous_frames
+        frames = bytearray(frame_size * timeline.length)
+        frames[:start*frame_size] = memoryview(previous_frames)[:start*frame_size]
+        frames[start*frame_size:end*frame_size] = rendered
+        frames[end*frame_size:] = memoryview(previous_frames)[previous_end*frame_size:]
+        return frames
+
+    def render_parallel(self, timeline, workers):
+        """
+        Renders the timeline like render() does, but splits it into a time segment per worker process.
+        Every worker renders the frames of its own segment, including the sound of the events
+        from earlier segments that rings into it, so the segments are exactly the same as in a single render.
+        The workers write their segment directly into a shared memory buffer.
+        """
+        frame_size = 4 * Sample.norm_nchannels
+        segment_frames = max(-(-timeline.length // workers), 1)
+        segments = [(start, min(start + segment_frames, timeline.length))
+                    for start in range(0, timeline.length, segment_frames)]
+        shared = shared_memory.SharedMemory(create=True, size=max(frame_size * timeline.length, 1))
+        try:
+            initargs = (self.bpm, self.ticks, timeline, shared.name)
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_render_worker,
+                                                        initargs=initargs) as executor:
+                for _ in executor.map(_render_segment, segments):
+                    pass
+            return bytearray(shared.buf[:frame_size * timeline.length])
+        finally:
+            shared.close()
+            shared.unlink()
+
+    def compile(self):
+        """
+        Compiles the patterns into a Timeline: the table of all trigger events of the song.
+        The events are positioned relative to the start frame of their pattern, so that every
+        occurrence of a pattern has exactly the same events (and can be rendered just once).
+        """
+        samplerate = Sample.norm_samplerate
+        names = list(self.instruments)
+        samples = [self.instruments[name] for name in names]
+        for sample in samples:
+            assert sample.samplewidth == 4
+            assert sample.samplerate == samplerate
+            assert sample.nchannels == Sample.norm_nchannels
+        ids = {name: instrument_id for instrument_id, name in enumerate(names)}
+        # the frame positions of the ticks are computed exactly, with integer arithmetic
+        frames_per_tick = fractions.Fraction(60 * samplerate) / (fractions.Fraction(self.bpm) * self.ticks)
+        numerator, denominator = frames_per_tick.numerator, frames_per_tick.denominator
+        total_ticks = sum(len(next(iter(p.values()))) for p in self.patterns)
+        timeline = Timeline(samples, total_ticks * numerator // denominator)
+        index = 0
+        compiled = {}
+        for pattern in self.patterns:
+            if id(pattern) not in compiled:
+                # the key identifies the pattern's sound: its bars, the instrument samples, and the tempo
+                bars = tuple(sorted((self.instruments[instrument].fingerprint, bars)
+                                    for instrument, bars in pattern.items()))
+                key = (samplerate, self.bpm, self.ticks, bars)
+                # the events of the pattern, relative to its start
+                ticks, rows, chars = pattern_triggers(pattern)
+                instrument_ids = [ids[name] for name in pattern]
+                tick_frames = [i * numerator // denominator for i in range(len(next(iter(pattern.values()))))]
+                if numpy:
+                    frames = numpy.array(tick_frames, dtype=numpy.int64)[ticks]
+                    instrument_ids = numpy.array(instrument_ids, dtype=numpy.uint32)[rows]
+                else:
+                    frames = [tick_frames[tick] for tick in ticks]
+                    instrument_ids = [instrument_ids[row] for row in rows]
+                compiled[id(pattern)] = (key, frames, instrument_ids, trigger_gains(chars), len(tick_frames))
+            key, frames, instrument_ids, gains, length = compiled[id(pattern)]
+            start = index * numerator // denominator
+            first_event = len(timeline)
+            timeline.add_events(frames + start if numpy else [start + frame for frame in frames], instrument_ids, gains)
+            timeline.sections.append((start, key, first_event, len(timeline)))
+            index += length
+        if self.choke_groups or self.voice_limits:
+            self._cut_voices(timeline, ids)
+        return timeline
+
+    def _cut_voices(self, timeline, ids):
+        # applies the choke groups and voice limits: sets the lengths of the events whose voices are cut off
+        groups = {ids[name]: group for name, group in self.choke_groups.items() if name in ids}
+        limits = {ids[name]: limit for name, limit in self.voice_limits.items() if name in ids}
+        fade = _fade_frames()
+        ends = {}                                   # event -> end frame, of the voices that may still be sounding
+        group_voices = collections.defaultdict(list)
+        instrument_voices = collections.defaultdict(list)
+
+        def cut(event, frame):
+            if timeline.lengths[event] < 0 and timeline.frames[event] < frame < ends[event]:
+                timeline.lengths[event] = frame - timeline.frames[event]
+                ends[event] = min(ends[event], frame + fade)
+
+        for event, (frame, instrument_id) in enumerate(zip(timeline.frames, timeline.instruments)):
+            if instrument_id not in groups and instrument_id not in limits:
+                continue
+            ends[event] = frame + len(timeline.samples[instrument_id])
+            if instrument_id in groups:
+                voices = group_voices[groups[instrument_id]]
+                for voice in voices:
+                    cut(voice, frame)
+                voices[:] = [voice for voice in voices if ends[voice] > frame]
+                voices.append(event)
+            if instrument_id in limits:
+                voices = instrument_voices[instrument_id]
+                voices[:] = [voice for voice in voices if ends[voice] > frame]
+                while len(voices) >= limits[instrument_id]:
+                    voice = voices.pop(0)
+                    cut(voice, frame)
+                voices.append(event)
+        # the sections with voices that are cut off (possibly by a trigger in a later section) sound different
+        for index, (start, key, first_event, end_event) in enumerate(timeline.sections):
+            cuts = tuple((event - first_event, timeline.lengths[event])
+                         for event in range(first_event, end_event) if timeline.lengths[event] >= 0)
+            if cuts:
+                timeline.sections[index] = (start, key + (cuts,), first_event, end_event)
+
+    def render(self, timeline, start=0, end=None):
+        """
+        Renders (a part of) the timeline into raw 32 bits sample frames (a bytearray), from the start frame
+        up to the end frame. The output is allocated only once. With numpy, every distinct pattern is rendered just once
+        (including its tail that spills into the next pattern), kept in the pattern cache, and added into
+        the output at every occurrence. If the sum of the overlapping events could exceed 32 bits,
+        the events are rendered in blocks via a 64 bits accumulator that is clipped into the output instead.
+        Without numpy, the events are mixed in one by one.
+        """
+        end = timeline.length if end is None else end
+        nchannels = Sample.norm_nchannels
+        frame_size = 4 * nchannels
+        result = bytearray(frame_size * (end-start))
+        if numpy:
+            output = numpy.frombuffer(result, dtype=numpy.int32).reshape(-1, nchannels)
+            scaled = {}     # (instrument id, gain, length) -> sample values
+            if timeline.peak_level() < 2**31:
+                if not timeline.sections:
+                    self._add_events(timeline, output, start, end, scaled)
+                pattern_cache = {} if self.pattern_cache is None else self.pattern_cache
+                for index, (section_start, key, _, _) in enumerate(timeline.sections):
+                    rendered = pattern_cache.get(key)
+                    if rendered is None:
+                        section = timeline.section(index)
+                        rendered = numpy.zeros((section.length, nchannels), dtype=numpy.int32)
+                        self._add_events(section, rendered, 0, section.length, scaled)
+                        rendered.flags.writeable = False
+                        pattern_cache[key] = rendered
+                    first, last = max(section_start, start), min(section_start + len(rendered), end)
+                    if first < last:
+                        output[first-start:last-start] += rendered[first-section_start:last-section_start]
+            else:
+                for block_start in range(start, end, self.block_frames):
+                    block_end = min(block_start + self.block_frames, end)
+                    accumulator = numpy.zeros((block_end-block_start, nchannels), dtype=numpy.int64)
+                    self._add_events(timeline, accumulator, block_start, block_end, scaled)
+                    numpy.clip(accumulator, -2**31, 2**31-1,
+                               out=output[block_start-start:block_end-start], casting="unsafe")
+            return result
+        events = zip(timeline.frames, timeline.instruments, timeline.gains, timeline.lengths)
+        for frame, instrument_id, gain, length in events:
+            sample = timeline.samples[instrument_id]
+            first, last = max(frame, start), min(frame + len(sample), end)
+            if first >= last:
+                continue
+            if gain != 1.0 or length >= 0:
+                fragment = voice_values(sample, gain, length)
+                last = min(frame + len(fragment) // frame_size, end)
+            else:
+                fragment = sample.view_frame_data()
+            fragment = fragment[(first-frame)*frame_size:(last-frame)*frame_size]
+            first, last = (first-start)*frame_size, (last-start)*frame_size
+            result[first:last] = dsp.add(result[first:last], fragment, 4)
+        return result
+
+    def _add_events(self, timeline, target, start, end, scaled):
+        # adds the sample values of all events that overlap the range start-end into the target array
+        if not len(timeline):
+            return
+        frames = numpy.frombuffer(timeline.frames, dtype=numpy.int64)
+        longest = max(len(sample) for sample in timeline.samples)
+        # the events are in chronological order, find the ones that can overlap the range
+        first_event = numpy.searchsorted(frames, start - longest, side="right")
+        end_event = numpy.searchsorted(frames, end, side="left")
+        for event in range(first_event, end_event):
+            frame = timeline.frames[event]
+            key = (timeline.instruments[event], timeline.gains[event], timeline.lengths[event])
+            if key not in scaled:
+                scaled[key] = voice_values(timeline.samples[key[0]], key[1], key[2])
+            values = scaled[key]
+            first, last = max(frame, start), min(frame + len(values), end)
+            if first < last:
+                target[first-start:last-start] += values[first-frame:last-frame]
+
+    def mix_generator(self, block_frames=4096):
         """
         Returns a generator that produces samples that are the chronological
         chunks of the final output mix. This avoids having to mix it into one big
-        output mix sample.
+        output mix sample. The chunks are blocks of a fixed size, produced by a Sequencer.
         """
         if not self.patterns:
             yield Sample()
             return
-        total_seconds = 0.0
-        for p in self.patterns:
-            bar = next(iter(p.values()))
-            total_seconds += len(bar) * 60.0 / self.bpm / self.ticks
-        mixed_duration = 0.0
-        samples = self.mixed_samples()
-        # get the first sample
-        index, previous_timestamp, sample = next(samples)
-        mixed = Sample().make_32bit()
-        mixed.mix_at(previous_timestamp, sample)
-        # continue mixing the following samples
-        for index, timestamp, sample in samples:
-            trigger_duration = timestamp-previous_timestamp
-            overflow = None
-            if mixed.duration < trigger_duration:
-                # fill with some silence to reach the next sample position
-                mixed.add_silence(trigger_duration - mixed.duration)
-            elif mixed.duration > trigger_duration:
-                # chop off the sound that extends into the next sample position
-                # keep this overflow and mix it later!
-                overflow = mixed.split(trigger_duration)
-            mixed_duration += mixed.duration
-            yield mixed
-            mixed = overflow if overflow else Sample().make_32bit()
-            mixed.mix(sample)
-            previous_timestamp = timestamp
-        # output the last remaining sample and extend it to the end of the duration if needed
-        timestamp = total_seconds
-        trigger_duration = timestamp-previous_timestamp
-        if mixed.duration < trigger_duration:
-            mixed.add_silence(trigger_duration - mixed.duration)
-        elif mixed.duration > trigger_duration:
-            mixed.clip(0, trigger_duration)
-        mixed_duration += mixed.duration
-        yield mixed
+        yield from Sequencer(self.compile(), block_frames)
 
     def mixed_triggers(self, tracker):
         """
         Generator for all triggers in chronological sequence.
         Every element is a tuple: (trigger index, time offset (seconds), list of (instrumentname, sample tuples)
+        The samples of triggers with a velocity or accent (see trigger_gains) are scaled copies, that are cached.
         """
         time_per_index = 60.0 / self.bpm / self.ticks
         index = 0
@@ -126,6 +535,14 @@ class Mixer:
                 for instrument, bars in pattern:
                     if bars[i] not in ". ":
                         sample = self.instruments[instrument]
+                        gain = float(trigger_gains([ord(bars[i])])[0])
+                        if gain != 1.0:
+                            variant_key = ("gain", sample.fingerprint, gain)
+                            scaled = self.mix_cache.get(variant_key)
+                            if scaled is None:
+                                scaled = sample.copy().amplify(gain).intern()
+                                self.mix_cache[variant_key] = scaled
+                            sample = scaled
                         triggers.append((instrument, sample))
                         triggered_instruments.add(instrument)
                 if triggers:
@@ -140,53 +557,162 @@ class Mixer:
         Generator for all samples-to-mix.
         Every element is a tuple: (trigger index, time offset (seconds), sample)
         """
-        mix_cache = {}  # we cache stuff to avoid repeated mixes of the same instruments
         for index, timestamp, triggers in self.mixed_triggers(tracker):
             if len(triggers) > 1:
                 # sort the samples to have the longest one as the first
                 # this allows us to allocate the target mix buffer efficiently
                 triggers = sorted(triggers, key=lambda t: t[1].duration, reverse=True)
-                instruments_key = tuple(instrument for instrument, _ in triggers)
-                if instruments_key in mix_cache:
-                    yield index, timestamp, mix_cache[instruments_key]
+                # the mixes of the same instrument samples (by their content) are cached
+                instruments_key = tuple(sorted(sample.fingerprint for _, sample in triggers))
+                mixed = self.mix_cache.get(instruments_key)
+                if mixed is not None:
+                    yield index, timestamp, mixed
                     continue
                 # duplicate the longest sample as target mix buffer, then mix the remaining samples into it
                 mixed = triggers[0][1].copy()
                 for _, sample in triggers[1:]:
                     mixed.mix(sample)
-                mixed.lock()
-                mix_cache[instruments_key] = mixed   # cache the mixed instruments sample
+                mixed = mixed.intern()
+                self.mix_cache[instruments_key] = mixed
                 yield index, timestamp, mixed
             else:
                 # simply yield the unmixed sample from the single trigger
                 yield index, timestamp, triggers[0][1]
 
 
+class Sequencer:
+    """
+    Realtime sequencer that produces the mix of a compiled song (Timeline) in blocks, on demand.
+    The triggers start at their exact frame positions. Every block is the mix of the voices
+    (triggered instrument samples) that are sounding during that block.
+    Iterating over the sequencer produces Samples of block_frames each, but you can also
+    pull the raw frames for any number of frames with read(), for instance from an audio callback.
+    The result is exactly the same as Mixer.render().
+    """
+    def __init__(self, timeline, block_frames=256):
+        assert block_frames > 0
+        self.timeline = timeline
+        self.block_frames = block_frames
+        self.position = 0           # frame position of the next block
+        self._next_event = 0
+        self._voices = []           # (start frame, instrument id, gain, length) of every sounding trigger, in order
+        self._values = {}           # (instrument id, gain, length) -> sample values or fragment
+
+    def __iter__(self):
+        while True:
+            frames = self.read(self.block_frames)
+            if frames is None:
+                return
+            yield Sample.from_raw_frames(frames, 4, Sample.norm_samplerate, Sample.norm_nchannels)
+
+    def read(self, frames):
+        """
+        Returns the raw 32 bits sample frames of the next part of the mix, of the given number of frames
+        (fewer for the last part of the song). Returns None when the end of the song has been reached.
+        """
+        if self.position >= self.timeline.length:
+            return None
+        start, end = self.position, min(self.position + frames, self.timeline.length)
+        timeline = self.timeline
+        while self._next_event < len(timeline) and timeline.frames[self._next_event] < end:
+            event = self._next_event
+            self._voices.append((timeline.frames[event], timeline.instruments[event],
+                                 timeline.gains[event], timeline.lengths[event]))
+            self._next_event += 1
+        nchannels = Sample.norm_nchannels
+        frame_size = 4 * nchannels
+        if numpy:
+            accumulator = numpy.zeros((end-start, nchannels), dtype=numpy.int64)
+        else:
+            result = bytearray(frame_size * (end-start))
+        voices = []
+        for voice in self._voices:
+            frame = voice[0]
+            values = self._voice_values(*voice[1:])
+            first, last = max(frame, start), min(frame + (len(values) if numpy else len(values) // frame_size), end)
+            if first < last:
+                if numpy:
+                    accumulator[first-start:last-start] += values[first-frame:last-frame]
+                else:
+                    first_byte, last_byte = (first-start)*frame_size, (last-start)*frame_size
+                    fragment = values[(first-frame)*frame_size:(last-frame)*frame_size]
+                    result[first_byte:last_byte] = dsp.add(result[first_byte:last_byte], fragment, 4)
+            if last == end:
+                voices.append(voice)    # still sounding in the next block
+        self._voices = voices
+        self.position = end
+        if numpy:
+            result = bytearray(frame_size * (end-start))
+            output = numpy.frombuffer(result, dtype=numpy.int32).reshape(-1, nchannels)
+            numpy.clip(accumulator, -2**31, 2**31-1, out=output, casting="unsafe")
+        return result
+
+    def _voice_values(self, instrument_id, gain, length):
+        key = (instrument_id, gain, length)
+        if key not in self._values:
+            self._values[key] = voice_values(self.timeline.samples[instrument_id], gain, length)
+        return self._values[key]
+
+
+_worker_mixer = _worker_timeline = _worker_output = None
+
+
+def _init_render_worker(bpm, ticks, timeline, output_name):
+    # the timeline (with the instrument samples) is sent to every worker process just once
+    global _worker_mixer, _worker_timeline, _worker_output
+    _worker_mixer = Mixer([], bpm, ticks, {})
+    _worker_timeline = timeline
+    _worker_output = shared_memory.SharedMemory(name=output_name)
+
+
+def _render_segment(segment):
+    start, end = segment
+    frame_size = 4 * Sample.norm_nchannels
+    _worker_output.buf[start*frame_size:end*frame_size] = _worker_mixer.render(_worker_timeline, start, end)
+
+
 class Song:
     """
     Represents a set of instruments, patterns and bars that make up a 'song'.
     """
     def __init__(self):
         self.instruments = {}
+        self.loops = {}     # loop instrument name -> (original sample, bpm of the loop)
+        self.choke_groups = {}      # instrument name -> choke group name
+        self.voice_limits = {}      # instrument name -> maximum number of simultaneous voices
         self.sample_path = None
-        self.bpm = 128
+        self.sample_files = {}      # instrument name -> sample file name (relative to the sample path)
+        self._bpm = 128
         self.ticks = 4
         self.pattern_sequence = []
         self.patterns = {}
+        # rendered patterns and mixed instrument combinations, shared by all mixes of the song
+        self.pattern_cache = RenderCache(256*1024*1024)
+        self.mix_cache = RenderCache(64*1024*1024)
+        self.sample_cache = SampleCache()
 
     def read(self, song_file, discard_unused_instruments=True):
-        """Read a song from a saved file."""
+        """
+        Read a song from a saved file. The song is also cached in a compact binary form (see write_compiled)
+        that is read instead of the file the next time, as long as the file doesn't change.
+        """
         with open(song_file):
             pass    # test for file existence
         print("Loading song...")
-        cp = ConfigParser()
-        cp.read(song_file)
-        self.sample_path = cp["paths"]["samples"]
-        self.read_samples(cp["samples"], self.sample_path)
-        if "song" in cp:
-            self.bpm = cp["song"].getint("bpm")
-            self.ticks = cp["song"].getint("ticks")
-            self.read_patterns(cp, cp["song"]["patterns"].split())
+        if not self.read_compiled(song_file):
+            cp = ConfigParser()
+            cp.read(song_file)
+            self.sample_path = cp["paths"]["samples"]
+            self.read_samples(cp["samples"], self.sample_path)
+            if "song" in cp:
+                self._bpm = cp["song"].getint("bpm")     # set before the loops are read, so they're retimed just once
+            if "loops" in cp:
+                self.read_loops(cp["loops"])
+            self.read_voices(cp["choke"] if "choke" in cp else {}, cp["voices"] if "voices" in cp else {})
+            if "song" in cp:
+                self.ticks = cp["song"].getint("ticks")
+                self.read_patterns(cp, cp["song"]["patterns"].split())
+            self.write_compiled(song_file)
         print("Done; {:d} instruments and {:d} patterns.".format(len(self.instruments), len(self.patterns)))
         unused_instruments = self.instruments.keys()
         for pattern_name in self.pattern_sequence:
@@ -194,14 +720,68 @@ class Song:
         if unused_instruments and discard_unused_instruments:
             for instrument in list(unused_instruments):
                 del self.instruments[instrument]
+                self.sample_files.pop(instrument, None)
+                self.loops.pop(instrument, None)
             print("Warning: there are unused instruments. They have been unloaded to save memory, and can safely be removed from the song file.")
             print("The unused instruments are:", ", ".join(sorted(unused_instruments)))
 
     def read_samples(self, instruments, samples_path):
-        """Reads the sample files for the instruments."""
+        """
+        Reads the sample files for the instruments. They're loaded by a pool of threads,
+        and the normalized samples are cached on disk (see SampleCache) so they load much faster the next time.
+        """
         self.instruments = {}
-        for name, file in sorted(instruments.items()):
-            self.instruments[name] = Sample(wave_file=os.path.join(samples_path, file)).normalize().make_32bit(scale_amplitude=False).lock()
+        self.loops = {}
+        self.sample_files = dict(instruments)
+        names = sorted(instruments)
+        filenames = [os.path.join(samples_path, instruments[name]) for name in names]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            samples = list(executor.map(self.sample_cache.load, filenames))
+        for name, sample in zip(names, samples):
+            # instruments that use the same sample file (or identical audio) share their sample data.
+            # The shared Sample has the filename of just one of them, so the song's own file names are in sample_files.
+            self.instruments[name] = sample.intern()
+
+    def read_loops(self, loops):
+        """
+        Reads the loop instruments: samples that contain a rhythm loop at the given bpm.
+        They're time stretched to stay in sync when the song's bpm is different (or changes).
+        """
+        self.loops = {}
+        for name, loop_bpm in loops.items():
+            if name not in self.instruments:
+                raise ValueError("loop instrument '{:s}' not defined".format(name))
+            self.loops[name] = (self.instruments[name], float(loop_bpm))
+        self.retime_loops()
+
+    def read_voices(self, choke_groups, voice_limits):
+        """Reads the choke groups (instrument -> group name) and the voice limits (instrument -> max voices)."""
+        for name in list(choke_groups) + list(voice_limits):
+            if name not in self.instruments:
+                raise ValueError("instrument '{:s}' not defined".format(name))
+        self.choke_groups = dict(choke_groups)
+        self.voice_limits = {}
+        for name, limit in voice_limits.items():
+            self.voice_limits[name] = int(limit)
+            if self.voice_limits[name] < 1:
+                raise ValueError("voice limit must be at least 1 (instrument: {:s})".format(name))
+
+    @property
+    def bpm(self):
+        return self._bpm
+
+    @bpm.setter
+    def bpm(self, bpm):
+        # changing the bpm also retimes the loop instruments
+        self._bpm = bpm
+        self.retime_loops()
+
+    def retime_loops(self):
+        """Time stretches the loop instruments from their own bpm to the song's bpm (keeping their pitch)."""
+        for name, (sample, loop_bpm) in self.loops.items():
+            if loop_bpm != self._bpm:
+                sample = sample.copy().time_stretch(loop_bpm / self._bpm).intern()
+            self.instruments[name] = sample
 
     def read_patterns(self, songdef, names):
         """Reads and parses the pattern specs from the song."""
@@ -224,15 +804,81 @@ class Song:
                 bar_length = len(bars)
             self.pattern_sequence.append(name)
 
+    def write_compiled(self, song_file):
+        """
+        Stores the song that was read from the song file in the cache directory, in a compact binary form:
+        a numpy .npz file with the song's parameters, and a matrix of the bar characters of every pattern
+        (zero where there's no trigger).
+        Requires numpy (otherwise nothing is cached).
+        """
+        if not numpy:
+            return
+        names = sorted(self.patterns)
+        header = {
+            "samples_path": self.sample_path,
+            "samples": self.sample_files,
+            "loops": {name: loop_bpm for name, (_, loop_bpm) in self.loops.items()},
+            "choke": self.choke_groups,
+            "voices": self.voice_limits,
+            "bpm": self.bpm,
+            "ticks": self.ticks,
+            "sequence": self.pattern_sequence,
+            "patterns": [[name, list(self.patterns[name])] for name in names]
+        }
+        arrays = {"header": numpy.frombuffer(json.dumps(header).encode(), dtype=numpy.uint8)}
+        for number, name in enumerate(names):
+            pattern = self.patterns[name]
+            ticks, rows, chars = pattern_triggers(pattern)
+            triggers = numpy.zeros((len(pattern), len(next(iter(pattern.values())))), dtype="<u4")
+            triggers[rows, ticks] = chars
+            arrays["pattern{:d}".format(number)] = triggers
+        self.sample_cache.store(self.sample_cache.cache_filename(song_file, ".song.npz"),
+                                lambda cache_file: numpy.savez(cache_file, **arrays))
+
+    def read_compiled(self, song_file):
+        """
+        Reads the song from its compiled form in the cache directory, if it's there (and numpy is available).
+        The bars don't have to be parsed and validated again. Returns True if the song was loaded.
+        """
+        if not numpy:
+            return False
+        try:
+            with numpy.load(self.sample_cache.cache_filename(song_file, ".song.npz"), allow_pickle=False) as compiled:
+                header = json.loads(compiled["header"].tobytes().decode())
+                patterns = {}
+                for number, (name, instruments) in enumerate(header["patterns"]):
+                    triggers = compiled["pattern{:d}".format(number)]
+                    chars = numpy.where(triggers == 0, ord("."), triggers).astype("<u4")
+                    patterns[name] = {instrument: row.tobytes().decode("utf-32-le")
+                                      for instrument, row in zip(instruments, chars)}
+        except (OSError, ValueError, KeyError):
+            return False
+        self.sample_path = header["samples_path"]
+        self.read_samples(header["samples"], self.sample_path)
+        self.loops = {}
+        self._bpm = header["bpm"]
+        if header["loops"]:
+            self.read_loops(header["loops"])
+        self.read_voices(header.get("choke", {}), header.get("voices", {}))
+        self.ticks = header["ticks"]
+        self.patterns = patterns
+        self.pattern_sequence = header["sequence"]
+        return True
+
     def write(self, output_filename):
         """Save the song definitions to an output file."""
-        import collections
         cp = ConfigParser(dict_type=collections.OrderedDict)
         cp["paths"] = {"samples": self.sample_path}
         cp["song"] = {"bpm": self.bpm, "ticks": self.ticks, "patterns": " ".join(self.pattern_sequence)}
         cp["samples"] = {}
-        for name, sample in sorted(self.instruments.items()):
-            cp["samples"][name] = os.path.basename(sample.filename)
+        for name in sorted(self.instruments):
+            cp["samples"][name] = self.sample_files[name]
+        if self.loops:
+            cp["loops"] = {name: "{:g}".format(loop_bpm) for name, (_, loop_bpm) in sorted(self.loops.items())}
+        if self.choke_groups:
+            cp["choke"] = collections.OrderedDict(sorted(self.choke_groups.items()))
+        if self.voice_limits:
+            cp["voices"] = collections.OrderedDict(sorted(self.voice_limits.items()))
         for name, pattern in sorted(self.patterns.items()):
             # Note: the layout of the patterns is not optimized for human viewing. You may want to edit it afterwards.
             cp["pattern."+name] = collections.OrderedDict(sorted(pattern.items()))
@@ -240,13 +886,21 @@ class Song:
             cp.write(f)
         print("Saved to '{:s}'.".format(output_filename))
 
-    def mix(self, output_filename):
-        """Mix the song into a resulting mix sample."""
+    def mixer(self, patterns=None):
+        """
+        Returns a Mixer for the given patterns (default: the pattern sequence of the song),
+        with the song's instruments, choke groups, voice limits and caches.
+        """
+        if patterns is None:
+            patterns = [self.patterns[name] for name in self.pattern_sequence]
+        return Mixer(patterns, self.bpm, self.ticks, self.instruments, self.pattern_cache, self.mix_cache,
+                     self.choke_groups, self.voice_limits)
+
+    def mix(self, output_filename, workers=1):
+        """Mix the song into a resulting mix sample. With more than one worker, it's rendered in parallel processes."""
         if not self.pattern_sequence:
             raise ValueError("There's nothing to be mixed; no song loaded or song has no patterns.")
-        patterns = [self.patterns[name] for name in self.pattern_sequence]
-        mixer = Mixer(patterns, self.bpm, self.ticks, self.instruments)
-        result = mixer.mix()
+        result = self.mixer().mix(workers=workers)
         result.make_16bit()
         result.write_wav(output_filename)
         print("Output is {:.2f} seconds, written to: {:s}".format(result.duration, output_filename))
@@ -257,18 +911,18 @@ class Song:
         Generator that produces all the instrument triggers needed to mix/stream the song.
         Shortcut for Mixer.mixed_triggers, see there for more details.
         """
-        patterns = [self.patterns[name] for name in self.pattern_sequence]
-        mixer = Mixer(patterns, self.bpm, self.ticks, self.instruments)
-        return mixer.mixed_triggers(False)
+        return self.mixer().mixed_triggers(False)
 
     def mix_generator(self):
         """
         Generator that produces samples that together form the mixed song.
         Shortcut for Mixer.mix_generator(), see there for more details.
         """
-        patterns = [self.patterns[name] for name in self.pattern_sequence]
-        mixer = Mixer(patterns, self.bpm, self.ticks, self.instruments)
-        return mixer.mix_generator()
+        return self.mixer().mix_generator()
+
+    def sequencer(self, block_frames=256):
+        """Returns a Sequencer that produces the mixed song in blocks, for realtime playback."""
+        return Sequencer(self.mixer().compile(), block_frames)
 
 
 class Repl(cmd.Cmd):
@@ -281,6 +935,7 @@ class Repl(cmd.Cmd):
         self.song = Song()
         self.discard_unused_instruments = discard_unused_instruments
         self.out = Output()
+        self.rendered = None    # (timeline, frames) of the last mix of the song, updated after edits
         super(Repl, self).__init__()
 
     def do_quit(self, args):
@@ -303,6 +958,14 @@ class Repl(cmd.Cmd):
         except ValueError as x:
             print("ERROR:", x)
 
+    def do_cache(self, args):
+        """show the statistics of the caches of rendered patterns and mixed instruments"""
+        for name, cache in (("patterns", self.song.pattern_cache), ("instrument mixes", self.song.mix_cache)):
+            stats = cache.stats()
+            print("{:>16s}: {:d} entries, {:.1f} of {:.0f} Mb, {:d} hits, {:d} misses ({:.0%} hit rate)"
+                  .format(name, stats["entries"], stats["bytes"]/2**20, stats["max_bytes"]/2**20,
+                          stats["hits"], stats["misses"], stats["hit_rate"]))
+
     def do_samples(self, args):
         """show the loaded samples"""
         print("Samples:")
@@ -331,7 +994,7 @@ class Repl(cmd.Cmd):
                 return
         patterns = [self.song.patterns[name] for name in names]
         try:
-            m = Mixer(patterns, self.song.bpm, self.song.ticks, self.song.instruments)
+            m = self.song.mixer(patterns)
             result = m.mix(verbose=len(patterns) > 1).make_16bit()
             self.out.play_sample(result)
         except ValueError as x:
@@ -371,17 +1034,32 @@ class Repl(cmd.Cmd):
         if not self.song.pattern_sequence:
             print("Nothing to be mixed.")
             return
-        output = "__temp_mix.wav"
-        self.song.mix(output)
-        mix = Sample(wave_file=output)
+        try:
+            mix = self.mix_song()
+        except ValueError as x:
+            print("ERROR:", x)
+            return
         print("Playing sound...")
-        self.out.play_sample(mix)
-        os.remove(output)
+        self.out.play_sample(mix.make_16bit())
+
+    def mix_song(self):
+        """
+        Mixes the song in memory. The previous mix is kept, and after edits only the
+        part of the song that has changed is mixed again, so this is quick.
+        """
+        mixer = self.song.mixer()
+        timeline = mixer.compile()
+        if self.rendered:
+            frames = mixer.render_changes(timeline, *self.rendered)
+        else:
+            frames = mixer.render(timeline)
+        self.rendered = (timeline, frames)
+        return Sample.from_raw_frames(frames, 4, Sample.norm_samplerate, Sample.norm_nchannels)
 
     def do_stream(self, args):
         """
         mix all patterns of the song and stream the output to your speakers in real-time,
-        or to an output file if you give a filename argument.
+        or to an output file if you give a filename argument (.raw or .pcm gives headerless sample data).
         This is the fastest and most efficient way of generating the output mix because
         it uses very little memory and avoids large buffer copying.
         """
@@ -396,15 +1074,16 @@ class Repl(cmd.Cmd):
             return
         print("Mixing and streaming to speakers...")
         try:
-            self.out.play_samples(self.song.mix_generator())
-            print("\r                          ")
+            self.out.play_source(self.song.sequencer())
             self.out.wait_all_played()
         except KeyboardInterrupt:
+            self.out.wipe_queue()
             print("Stopped.")
 
     def do_rec(self, args):
         """Record (or overwrite) a new sample (instrument) bar in a pattern.
 Args: [pattern name] [sample] [bar(s)].
+Use 1-9 in the bars for softer triggers and X for accents.
 Omit bars to remove the sample from the pattern.
 If a pattern with the name doesn't exist yet it will be added."""
         args = args.split(maxsplit=2)
@@ -457,6 +1136,7 @@ If a pattern with the name doesn't exist yet it will be added."""
         try:
             song.read(filename, self.discard_unused_instruments)
             self.song = song
+            self.rendered = None
         except IOError as x:
             print("ERROR:", x)
 
@@ -94,6 +94,17 @@ class AudioApi:
     def register_notify_played(self, callback):
         raise NotImplementedError
 
+    def play_source(self, read, block_frames):
+        """
+        Plays the frames that the read function produces. It is called with the number of frames
+        that is wanted, and returns None at the end. This api simply queues the frames in blocks.
+        """
+        while True:
+            frames = read(block_frames)
+            if frames is None:
+                break
+            self.play(Sample.from_raw_frames(frames, self.samplewidth, self.samplerate, self.nchannels))
+
 
 class PyAudio(AudioApi):
     """Api to the somewhat older pyaudio library (that uses portaudio)"""
@@ -202,6 +213,8 @@ class SounddeviceThread(AudioApi):
         self.output_thread = None
         self.all_played = threading.Event()
         self.played_callback = None
+        self.pull_source = None
+        self.blocksize = None
         global sounddevice
         import sounddevice
 
@@ -306,33 +319,31 @@ class Sounddevice(AudioApi):
                     self.queue_empty_event.set()
                     yield None
         def next_chunk(self, size):
-            if not self.current_item:
-                data = next(self.queue_items)
-                if not data:
-                    return None
-                self.current_item = memoryview(data)
-                self.i = 0
-            rest_current = len(self.current_item) - self.i
-            if size <= rest_current:
-                # current item still contains enough data
-                result = self.current_item[self.i:self.i+size]
-                self.i += size
-                return result
-            # current item is too small, get more data from the queue
-            # we assume the size of the chunks in the queue is >= required block size
-            data = next(self.queue_items)
-            if data:
-                result = self.current_item[self.i:].tobytes()
-                self.i = size - len(result)
-                result += data[0:self.i]
-                self.current_item = memoryview(data)
-                assert len(result)==size, "queue blocks need to be >= buffersize"
-                return result
-            else:
-                # no new data available, just return the last remaining data from current block
-                result = self.current_item[self.i:]
-                self.current_item = None
-                return result or None
+            result = None
+            while True:
+                if not self.current_item:
+                    data = next(self.queue_items)
+                    if not data:
+                        # no new data available, just return what we have
+                        return result or None
+                    self.current_item = memoryview(data)
+                    self.i = 0
+                rest_current = len(self.current_item) - self.i
+                if result is None and size <= rest_current:
+                    # current item still contains enough data, return a view on it (no copying)
+                    result = self.current_item[self.i:self.i+size]
+                    self.i += size
+                    return result
+                # current item is too small, gather the data from the next item(s) in the queue
+                if result is None:
+                    result = bytearray()
+                taken = min(size - len(result), rest_current)
+                result += self.current_item[self.i:self.i+taken]
+                self.i += taken
+                if self.i == len(self.current_item):
+                    self.current_item = None
+                if len(result) == size:
+                    return result
 
     def __init__(self):
         super().__init__()
@@ -341,6 +352,8 @@ class Sounddevice(AudioApi):
         self.buffer_queue_reader = None
         self.all_played = threading.Event()
         self.played_callback = None
+        self.pull_source = None
+        self.blocksize = None
         global sounddevice
         import sounddevice
 
@@ -381,6 +394,7 @@ class Sounddevice(AudioApi):
         self.buffer_queue.put(grabber.buffer)
 
     def wipe_queue(self):
+        self.pull_source = None
         try:
             while True:
                 self.buffer_queue.get(block=False)
@@ -403,14 +417,33 @@ class Sounddevice(AudioApi):
             dtype = "int32"
         else:
             raise ValueError("invalid sample width")
-        frames_per_chunk = self.samplerate // 20
+        frames_per_chunk = self.blocksize or self.samplerate // 20
         self.buffer_queue_reader = Sounddevice.BufferQueueReader(self.buffer_queue)
         self.stream = sounddevice.RawOutputStream(self.samplerate, channels=self.nchannels, dtype=dtype,
             blocksize=frames_per_chunk, callback=self.streamcallback)
         self.stream.start()
 
+    def play_source(self, read, block_frames):
+        """
+        Plays the frames that the read function produces, in pull mode: the stream callback directly
+        calls it for the frames of every block (no queueing, so low latency). The stream's block size
+        is set to block_frames. This returns immediately, use wait_all_played() to wait for the end.
+        """
+        if self.blocksize != block_frames:
+            self.blocksize = block_frames
+            self._recreate_outputter()
+        # the source must be in place before the event is cleared, or a callback in between would set it again
+        self.pull_source = read
+        self.all_played.clear()
+
     def streamcallback(self, outdata, frames, time, status):
-        data = self.buffer_queue_reader.next_chunk(len(outdata))
+        data = None
+        if self.pull_source:
+            data = self.pull_source(frames)
+            if data is None:
+                self.pull_source = None
+        if data is None:
+            data = self.buffer_queue_reader.next_chunk(len(outdata))
         if not data:
             # no frames available, use silence
             data = b"\0" * len(outdata)
@@ -502,7 +535,10 @@ class Output:
         self.audio_api.close()
 
     def play_sample(self, sample):
-        """Play a single sample (asynchronously)."""
+        """
+        Play a single sample (asynchronously).
+        To play a long sample in small blocks, play the chunks from its iter_chunks() (they're not copied).
+        """
         assert sample.samplewidth == self.samplewidth
         assert sample.samplerate == self.samplerate
         assert sample.nchannels == self.nchannels
@@ -517,26 +553,50 @@ class Output:
         else:
             raise RuntimeError("You need an audio api that supports streaming, to play many samples in sequence.")
 
+    def play_source(self, source, global_amplification=26000):
+        """
+        Plays the audio that the source (such as a mixer.Sequencer) produces: its read(frames) method
+        returns the next raw 32 bits frames, or None at the end. It's read in blocks of source.block_frames
+        and normalized to 16 bit like play_samples does. With the sounddevice callback api, the audio callback
+        pulls the blocks directly from the source (low latency), otherwise the blocks are queued.
+        """
+        if not self.audio_api.supports_streaming:
+            raise RuntimeError("You need an audio api that supports streaming, to play many samples in sequence.")
+
+        def read(frames):
+            frames = source.read(frames)
+            if frames is None:
+                return None
+            sample = Sample.from_raw_frames(frames, 4, self.samplerate, self.nchannels)
+            return next(self.normalized_samples([sample], global_amplification)).view_frame_data()
+
+        self.audio_api.play_source(read, source.block_frames)
+
     def wait_all_played(self):
         self.audio_api.wait_all_played()
 
     def normalized_samples(self, samples, global_amplification=26000):
         """Generator that produces samples normalized to 16 bit using a single amplification value for all."""
         for sample in samples:
+            if sample.samplewidth != 2 or sample.nchannels != 2:
+                sample = sample.copy()      # the sample can be locked, for instance when it's a chunk of a larger one
             if sample.samplewidth != 2:
                 # We can't use automatic global max amplitude because we're streaming
                 # the samples individually. So use a fixed amplification value instead
                 # that will be used to amplify all samples in stream by the same amount.
                 sample = sample.amplify(global_amplification).make_16bit(False)
-            if sample.nchannels == 1:
-                sample.stereo()
+            if sample.nchannels != 2:
+                sample.remix(2)
             assert sample.nchannels == 2
             assert sample.samplerate == 44100
             assert sample.samplewidth == 2
             yield sample
 
     def stream_to_file(self, filename, samples):
-        """Saves the samples after each other into one single output wav file."""
+        """
+        Saves the samples after each other into one single output wav file.
+        The samples can also be the chunks from a sample's iter_chunks() (they're not copied).
+        """
         samples = self.normalized_samples(samples, 26000)
         sample = next(samples)
         with Sample.wave_write_begin(filename, sample) as out:
@@ -0,0 +1,144 @@
+"""
+High quality sample rate conversion using a polyphase windowed-sinc filter.
+Much better sounding than the simple linear interpolation that audioop.ratecv does.
+The polyphase filter banks are precomputed once per rate ratio and quality setting.
+Requires numpy.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import math
+import functools
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+from . import dsp
+
+
+__all__ = ["Resampler", "resample", "quality_settings", "frames_to_array", "array_to_frames"]
+
+
+quality_settings = {
+    # quality: (number of sinc zero crossings on each side, kaiser window beta, passband rolloff)
+    "low": (8, 6.0, 0.88),
+    "medium": (16, 8.0, 0.93),
+    "high": (32, 10.0, 0.96),
+}
+
+max_phases = 1024     # above this number of filter phases, the fractional position is rounded to the nearest phase
+block_size = 8192     # number of output frames computed in one vectorized step (for rounded phases)
+
+
+@functools.lru_cache(maxsize=32)
+def filter_bank(up, down, quality):
+    """
+    Returns the polyphase filter bank (phases x taps array) for resampling by the ratio up/down.
+    Row p contains the filter taps for an output position that lies p/phases input frames
+    after an input frame. Every row is normalized to unity gain.
+    """
+    zero_crossings, beta, rolloff = quality_settings[quality]
+    cutoff = min(1.0, up/down) * rolloff    # relative to the input Nyquist frequency
+    half_width = zero_crossings / cutoff    # in input frames
+    half_taps = int(math.ceil(half_width))
+    phases = min(up, max_phases)
+    # tap k of phase p is applied to the input frame at offset (k - half_taps + 1) from the position
+    x = (numpy.arange(phases) / phases).reshape(-1, 1) + (half_taps - 1 - numpy.arange(2*half_taps))
+    window = numpy.i0(beta * numpy.sqrt(numpy.clip(1.0 - (x/half_width)**2, 0.0, 1.0))) / numpy.i0(beta)
+    window[numpy.abs(x) > half_width] = 0.0
+    bank = cutoff * numpy.sinc(cutoff * x) * window
+    bank /= bank.sum(axis=1, keepdims=True)
+    bank.flags.writeable = False
+    return bank
+
+
+class Resampler:
+    """
+    Stateful sample rate converter for raw sample frames, that you can feed in chunks.
+    The filter state is carried across calls, so there are no clicks at chunk boundaries.
+    Call flush() at the end to obtain the last frames. The output is time-aligned with the input
+    (there is no filter delay), and the total number of frames produced is ceil(input_frames*outrate/inrate).
+    Quality is one of 'low', 'medium' or 'high' (see quality_settings).
+    """
+    def __init__(self, inrate, outrate, samplewidth, nchannels, quality="medium"):
+        assert inrate > 0 and outrate > 0
+        assert 1 <= samplewidth <= 4
+        if quality not in quality_settings:
+            raise ValueError("invalid quality, choose one of: " + ", ".join(quality_settings))
+        divisor = math.gcd(int(inrate), int(outrate))
+        self.up = int(outrate) // divisor
+        self.down = int(inrate) // divisor
+        self.samplewidth = samplewidth
+        self.nchannels = nchannels
+        self.bank = filter_bank(self.up, self.down, quality)
+        self.phases, self.taps = self.bank.shape
+        self.half_taps = self.taps // 2
+        # buffered input frames (one row per channel), starting at (absolute) input frame index buffer_start
+        self._buffer = numpy.zeros((nchannels, self.half_taps-1))
+        self._buffer_start = -(self.half_taps-1)
+        self._received = 0
+        self._next_output = 0
+
+    def process(self, frames):
+        """Resample a chunk of raw sample frames. Returns the resampled frames that are available so far."""
+        values = frames_to_array(frames, self.samplewidth, self.nchannels)
+        self._buffer = numpy.concatenate((self._buffer, values.T), axis=1)
+        self._received += len(values)
+        # output n can be computed when all input frames up to its position+half_taps have been received
+        # (rounding to the nearest phase can move the position one frame further)
+        last_base = self._received - 1 - self.half_taps - (self.phases != self.up)
+        end = ((last_base+1)*self.up - 1) // self.down + 1 if last_base >= 0 else 0
+        return array_to_frames(self._compute(end), self.samplewidth)
+
+    def flush(self):
+        """Returns the remaining frames at the end of the input (the input is padded with silence)."""
+        end = -(-self._received*self.up // self.down)
+        self._buffer = numpy.concatenate((self._buffer, numpy.zeros((self.nchannels, self.taps))), axis=1)
+        return array_to_frames(self._compute(end), self.samplewidth)
+
+    def _compute(self, end):
+        count = max(0, end - self._next_output)
+        result = numpy.empty((count, self.nchannels))
+        if count and self.phases == self.up:
+            # Outputs n and n+up use the same filter phase, and their input windows lie 'down' frames apart.
+            # So every phase is a matrix-vector product with a strided sliding window view of the input.
+            windows = [sliding_window_view(channel, self.taps) for channel in self._buffer]
+            for offset in range(min(count, self.up)):
+                position = (self._next_output+offset) * self.down
+                first = position // self.up - (self.half_taps-1) - self._buffer_start
+                length = len(range(offset, count, self.up))
+                for channel, window in enumerate(windows):
+                    result[offset::self.up, channel] = \
+                        window[first:first+length*self.down:self.down] @ self.bank[position % self.up]
+        elif count:
+            window_offsets = numpy.arange(self.taps)
+            for offset in range(0, count, block_size):
+                n = numpy.arange(self._next_output+offset, self._next_output+min(count, offset+block_size))
+                position = n * self.down
+                phase = (position % self.up * self.phases + self.up//2) // self.up
+                base = position // self.up + phase // self.phases
+                first = base - (self.half_taps-1) - self._buffer_start
+                windows = self._buffer[:, first.reshape(-1, 1) + window_offsets]
+                result[offset:offset+len(n)] = numpy.einsum("nt,cnt->nc", self.bank[phase % self.phases], windows)
+        self._next_output += count
+        # discard the buffered frames that are no longer needed
+        needed = (self._next_output*self.down) // self.up - self.half_taps - self._buffer_start
+        if needed > 0:
+            self._buffer = self._buffer[:, needed:]
+            self._buffer_start += needed
+        return result
+
+
+def frames_to_array(frames, samplewidth, nchannels):
+    """Returns the raw sample frames as a float array (frames x channels), in the integer sample value range."""
+    return dsp.unpack(frames, samplewidth).reshape(-1, nchannels).astype(float)
+
+
+def array_to_frames(values, samplewidth):
+    """Rounds and clips the sample values to the sample width, and returns them as raw sample frames."""
+    maxvalue = 2**(8*samplewidth-1)
+    return dsp.pack(numpy.clip(numpy.rint(values), -maxvalue, maxvalue-1).reshape(-1), samplewidth)
+
+
+def resample(frames, samplewidth, nchannels, inrate, outrate, quality="medium"):
+    """Resample the given raw sample frames in one go. Returns the new frames."""
+    resampler = Resampler(inrate, outrate, samplewidth, nchannels, quality)
+    return resampler.process(frames) + resampler.flush()
@@ -7,28 +7,35 @@ Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
 
 import sys
 import wave
-import audioop
 import array
 import math
 import itertools
+import hashlib
+import weakref
 try:
     import numpy
 except ImportError:
     numpy = None
+from . import dsp
+from .wavewriter import BufferedWaveWriter
 
 
-__all__ = ["Sample", "LevelMeter"]
+__all__ = ["Sample", "SampleBuilder", "LevelMeter"]
 
 
 samplewidths_to_arraycode = {
     1: 'b',
     2: 'h',
+    3: 'l',   # 24 bit sample values are stored in 32 bit array items
     4: 'l'    # or 'i' on 64 bit systems
 }
 
 # the actual array type code for the given sample width varies
 if array.array('i').itemsize == 4:
-    samplewidths_to_arraycode[4] = 'i'
+    samplewidths_to_arraycode[3] = samplewidths_to_arraycode[4] = 'i'
+
+# registry of the interned samples by their fingerprint (see Sample.intern)
+_interned_samples = weakref.WeakValueDictionary()
 
 
 class Sample:
@@ -36,19 +43,23 @@ class Sample:
     Audio sample data. Supports integer sample formats of 2, 3 and 4 bytes per sample (no floating-point).
     Python 3.4+ is required to support 3-bytes/24-bits sample sizes.
     Most operations modify the sample data in place (if it's not locked) and return the sample object,
-    so you can easily chain several operations.
+    so you can easily chain several operations. In lazy mode (see the lazy method) a chain of operations
+    is not performed right away, but in a single fused pass over the data when the frames are needed.
     """
     norm_samplerate = 44100
     norm_nchannels = 2
     norm_samplewidth = 2
+    resample_quality = "medium"     # 'linear' (fast but poor), or one of resampler.quality_settings (needs numpy)
 
     def __init__(self, wave_file=None):
         """Creates a new empty sample, or loads it from a wav file."""
         self.__locked = False
+        self.__lazy = False
+        self.__fingerprint = None
         if wave_file:
             self.load_wav(wave_file)
             self.__filename = wave_file
-            assert 1 <= self.__nchannels <= 2
+            assert self.__nchannels >= 1
             assert 2 <= self.__samplewidth <= 4
             assert self.__samplerate > 1
         else:
@@ -71,10 +82,15 @@ class Sample:
             self.__nchannels == other.__nchannels and \
             self.__frames == other.__frames
 
+    def __hash__(self):
+        if not self.__locked:
+            raise TypeError("only a locked sample is hashable")
+        return hash(self.fingerprint)
+
     @classmethod
     def from_raw_frames(cls, frames, samplewidth, samplerate, numchannels):
         """Creates a new sample directly from the raw sample data."""
-        assert 1 <= numchannels <= 2
+        assert numchannels >= 1
         assert 2 <= samplewidth <= 4
         assert samplerate > 1
         s = cls()
@@ -85,8 +101,13 @@ class Sample:
         return s
 
     @classmethod
-    def from_array(cls, array_or_list, samplerate, numchannels):
-        assert 1 <= numchannels <= 2
+    def from_array(cls, array_or_list, samplerate, numchannels, samplewidth=None):
+        """
+        Creates a sample from an array or list of integer sample values.
+        Normally the sample width follows from the array's item size. With samplewidth=3,
+        the values (that must fit in 24 bits) are packed into 24 bit samples.
+        """
+        assert numchannels >= 1
         assert samplerate > 1
         if isinstance(array_or_list, list):
             try:
@@ -101,12 +122,17 @@ class Sample:
             if any(array_or_list):
                 if type(array_or_list[0]) is not int:
                     raise TypeError("the sample values must be integer")
-        samplewidth = array_or_list.itemsize
-        assert 2 <= samplewidth <= 4
+        itemsize = array_or_list.itemsize
+        assert 2 <= itemsize <= 4
         frames = array_or_list.tobytes()
         if sys.byteorder == "big":
-            frames = audioop.byteswap(frames, samplewidth)
-        return Sample.from_raw_frames(frames, samplewidth, samplerate, numchannels)
+            frames = dsp.byteswap(frames, itemsize)
+        if samplewidth == 3:
+            assert itemsize == 4
+            # shift the values into the top 24 bits, then drop the lowest byte
+            frames = dsp.lin2lin(dsp.mul(frames, 4, 256), 4, 3)
+            itemsize = 3
+        return Sample.from_raw_frames(frames, itemsize, samplerate, numchannels)
 
     @property
     def samplewidth(self):
@@ -128,17 +154,20 @@ class Sample:
     @property
     def filename(self): return self.__filename
 
+    @filename.setter
+    def filename(self, filename): self.__filename = filename
+
     @property
     def duration(self):
-        return len(self.__frames) / self.__samplerate / self.__samplewidth / self.__nchannels
+        return len(self) / self.__samplerate     # in lazy mode, this doesn't execute the pending operations
 
     @property
     def maximum(self):
-        return audioop.max(self.__frames, self.samplewidth)
+        return dsp.max(self.__frames, self.samplewidth)
 
     @property
     def rms(self):
-        return audioop.rms(self.__frames, self.samplewidth)
+        return dsp.rms(self.__frames, self.samplewidth)
 
     @property
     def level_db_peak(self):
@@ -153,40 +182,164 @@ class Sample:
         Returns the average audio volume level measured in dB (range -60 db to 0 db)
         If the sample is stereo, you get back a tuple: (left_level, right_level)
         If the sample is mono, you still get a tuple but both values will be the same.
+        For more than two channels, the levels of the first two channels are returned.
         This method is probably only useful if processed on very short sample fragments in sequence,
         so the db levels could be used to show a level meter for the duration of the sample.
         """
+        levels = self.level_db_channels(rms_mode)
+        return levels[0], levels[min(1, len(levels)-1)]
+
+    def level_db_channels(self, rms_mode=False, decimation=1):
+        """
+        Returns the audio volume level of every channel measured in dB (range -60 db to 0 db), as a tuple.
+        The levels are computed directly on the interleaved sample data, without splitting the channels.
+        With a decimation factor only every n-th frame is examined, which is a lot faster
+        and usually accurate enough for a level meter.
+        """
         maxvalue = 2**(8*self.__samplewidth-1)
-        if self.nchannels == 1:
-            if rms_mode:
-                peak_left = peak_right = (audioop.rms(self.__frames, self.__samplewidth)+1)/maxvalue
-            else:
-                peak_left = peak_right = (audioop.max(self.__frames, self.__samplewidth)+1)/maxvalue
-        else:
-            left_frames = audioop.tomono(self.__frames, self.__samplewidth, 1, 0)
-            right_frames = audioop.tomono(self.__frames, self.__samplewidth, 0, 1)
-            if rms_mode:
-                peak_left = (audioop.rms(left_frames, self.__samplewidth)+1)/maxvalue
-                peak_right = (audioop.rms(right_frames, self.__samplewidth)+1)/maxvalue
-            else:
-                peak_left = (audioop.max(left_frames, self.__samplewidth)+1)/maxvalue
-                peak_right = (audioop.max(right_frames, self.__samplewidth)+1)/maxvalue
+        peaks, rms = dsp.levels(self.__frames, self.__samplewidth, self.__nchannels, decimation)
         # cut off at the bottom at -60 instead of all the way down to -infinity
-        return max(20.0*math.log(peak_left, 10), -60.0), max(20.0*math.log(peak_right, 10), -60.0)
+        return tuple(max(20.0*math.log((level+1)/maxvalue, 10), -60.0) for level in (rms if rms_mode else peaks))
+
+    def level_history(self, frames_per_bin):
+        """
+        Returns the minimum and maximum sample values of every channel, per bin of the given number of frames.
+        This is a short history to display a waveform: a list with a list of (min, max) tuples for every channel.
+        """
+        assert frames_per_bin > 0
+        return dsp.minmax(self.__frames, self.__samplewidth, self.__nchannels, frames_per_bin)
 
     def __len__(self):
         """returns the number of sample frames"""
-        return len(self.__frames) // self.__samplewidth // self.__nchannels
+        if self.__plan:
+            return self.__plan.nframes
+        return len(self.__data) // self.__samplewidth // self.__nchannels
+
+    @property
+    def __frames(self):
+        if self.__plan:
+            # perform the pending operations of the lazy mode now, because the frames are needed
+            self.__data = self.__plan.execute()
+            self.__plan = None
+        return self.__data
+
+    @__frames.setter
+    def __frames(self, frames):
+        self.__data = frames
+        self.__plan = None
+
+    def lazy(self, enabled=True):
+        """
+        Switch lazy mode on (or off). In lazy mode, operations such as clip, resample, normalize, make_32bit,
+        amplify and fades are recorded instead of performed immediately. They're executed in one fused pass
+        over the sample data, block by block, as soon as the frames are needed (by any other operation).
+        A clip is then done first, so only the part of the sample that is kept is processed at all.
+        """
+        self.__lazy = enabled
+        return self
+
+    def __lazy_plan(self):
+        if not self.__plan:
+            self.__plan = _LazyPlan(self.__data, self.__samplewidth, self.__nchannels)
+        return self.__plan
+
+    def __pointwise(self, operation):
+        """Perform a frame-wise operation (see _pointwise_op), or record it when in lazy mode."""
+        if self.__lazy:
+            self.__lazy_plan().pointwise(operation)
+        else:
+            self.__frames = _pointwise_op(operation, self.__frames, 0)
+
+    def __remix(self, matrix):
+        self.__pointwise(("remix", self.__samplewidth, self.__nchannels, tuple(map(tuple, matrix))))
+        self.__nchannels = len(matrix)
 
     def get_frame_array(self):
-        """Returns the sample values as array. Warning: this can copy large amounts of data."""
+        """
+        Returns the sample values as array. Warning: this can copy large amounts of data.
+        24 bit sample values are returned in an array of 32 bit items.
+        """
+        if self.samplewidth == 3:
+            if numpy:
+                return Sample.get_array(3, dsp.unpack(self.__frames, 3).astype("=i4").tobytes())
+            values = Sample.get_array(4, dsp.lin2lin(self.__frames, 3, 4))
+            return Sample.get_array(3, [v >> 8 for v in values])
         return Sample.get_array(self.samplewidth, self.__frames)
 
+    def view_frame_data(self):
+        """Directly returns a (read-only) view on the raw frames data, without copying it."""
+        return memoryview(self.__frames)
+
+    def iter_chunks(self, frames_per_chunk, pad=False):
+        """
+        Generator that splits the sample into consecutive chunks of the given number of frames.
+        The chunks are locked Samples whose frames are read-only views on the data of this sample,
+        so nothing is copied (this sample shouldn't be modified while the chunks are in use).
+        The last chunk can be shorter, unless pad is True: then it is padded with silence to the full size.
+        Ideal to feed a long sample to an audio output or stream in small blocks.
+        """
+        assert frames_per_chunk > 0
+        frames = memoryview(self.__frames)
+        chunk_size = frames_per_chunk * self.__samplewidth * self.__nchannels
+        for start in range(0, len(frames), chunk_size):
+            chunk = frames[start:start+chunk_size]
+            if pad and len(chunk) < chunk_size:
+                chunk = chunk.tobytes() + b"\0" * (chunk_size-len(chunk))
+            yield Sample.from_raw_frames(chunk, self.__samplewidth, self.__samplerate, self.__nchannels).lock()
+
     @staticmethod
     def get_array(samplewidth, initializer=None):
         """Returns an array with the correct type code, optionally initialized with values."""
         return array.array(samplewidths_to_arraycode[samplewidth], initializer or [])
 
+    @staticmethod
+    def channel_matrix(nchannels, new_nchannels):
+        """
+        Returns the default channel matrix to convert to another number of channels (see remix):
+        a mono channel is copied to all channels, and when up-mixing the channels are repeated.
+        Down-mixing the standard speaker layouts (in the default wav channel order, up to 7.1) is done like
+        ITU-R BS.775: channels that the new layout doesn't have are folded into the nearest speakers,
+        for instance L' = L + 0.707*C + 0.707*Ls, and the LFE channel is left out.
+        Down-mixing to mono is the average of the stereo down-mix. For other layouts the first channels are kept,
+        and the remaining ones are spread equally over all channels. The rows that fold several channels
+        together are normalized (their factors add up to 1), so the new channels can't exceed full scale.
+        """
+        assert nchannels >= 1 and new_nchannels >= 1
+        if new_nchannels >= nchannels:
+            return [_channel_selection(channel % nchannels, nchannels) for channel in range(new_nchannels)]
+        if new_nchannels == 1:
+            left, right = Sample.channel_matrix(nchannels, 2)
+            return [[(l + r) / 2 for l, r in zip(left, right)]]
+        matrix = [[0.0] * nchannels for _ in range(new_nchannels)]
+        if nchannels in _speaker_layouts and new_nchannels in _speaker_layouts:
+            speakers = _speaker_layouts[new_nchannels]
+
+            def fold(channel, speaker, factor):
+                if speaker in speakers:
+                    matrix[speakers.index(speaker)][channel] += factor
+                else:
+                    for target, target_factor in _speaker_folds[speaker]:
+                        fold(channel, target, factor * target_factor)
+
+            for channel, speaker in enumerate(_speaker_layouts[nchannels]):
+                fold(channel, speaker, 1.0)
+        else:
+            for channel in range(nchannels):
+                if channel < new_nchannels:
+                    matrix[channel][channel] = 1.0
+                else:
+                    for row in matrix:
+                        row[channel] = 1.0 / new_nchannels
+        return [[factor / max(sum(row), 1.0) for factor in row] for row in matrix]
+
+    def __getstate__(self):
+        # for pickling, the sample data can't be a view on other data (such as a memory mapped file)
+        state = self.__dict__.copy()
+        frames = self.__frames
+        state["_Sample__data"] = frames if isinstance(frames, (bytes, bytearray)) else bytes(frames)
+        state["_Sample__plan"] = None
+        return state
+
     def copy(self):
         """Returns a copy of the sample (unlocked)."""
         cpy = Sample()
@@ -197,6 +350,8 @@ class Sample:
         """Overwrite the current sample with a copy of the other."""
         assert not self.__locked
         self.__frames = other.__frames
+        if isinstance(self.__frames, memoryview):
+            self.__frames = self.__frames.tobytes()     # don't share a view on another sample's data (see iter_chunks)
         self.__samplewidth = other.__samplewidth
         self.__samplerate = other.__samplerate
         self.__nchannels = other.__nchannels
@@ -208,6 +363,30 @@ class Sample:
         self.__locked = True
         return self
 
+    @property
+    def fingerprint(self):
+        """
+        Content hash (16 bytes) of the sample data and its format: samples with identical audio
+        have the same fingerprint. Once the sample is locked, it is only computed once.
+        """
+        if self.__fingerprint:
+            return self.__fingerprint
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update("{:d}:{:d}:{:d}:".format(self.__samplewidth, self.__samplerate, self.__nchannels).encode("ascii"))
+        digest.update(self.__frames)
+        if self.__locked:
+            self.__fingerprint = digest.digest()
+        return digest.digest()
+
+    def intern(self):
+        """
+        Hash-consing: returns the one (locked) Sample that holds the same audio as this sample, if there is
+        such a sample in use already. Otherwise this sample is locked and registered as that one.
+        Identical samples then share a single buffer, and they can be recognised by identity.
+        """
+        self.lock()
+        return _interned_samples.setdefault(self.fingerprint, self)
+
     def frame_idx(self, seconds):
         """Calculate the raw frame bytes index for the sample at the given timestamp."""
         return self.nchannels*self.samplewidth*int(self.samplerate*seconds)
@@ -218,8 +397,6 @@ class Sample:
         with wave.open(file_or_stream) as w:
             if not 2 <= w.getsampwidth() <= 4:
                 raise IOError("only supports sample sizes of 2, 3 or 4 bytes")
-            if not 1 <= w.getnchannels() <= 2:
-                raise IOError("only supports mono or stereo channels")
             self.__nchannels = w.getnchannels()
             self.__samplerate = w.getframerate()
             self.__samplewidth = w.getsampwidth()
@@ -244,26 +421,26 @@ class Sample:
             out.writeframes(self.__frames)
 
     @classmethod
-    def wave_write_begin(cls, filename, first_sample):
+    def wave_write_begin(cls, filename, first_sample, format=None):
         """
         Part of the sample stream output api: begin writing a sample to an output file.
-        Returns the open file for future writing.
+        Returns the open file for future writing. The data is written in large blocks by a background
+        thread (see BufferedWaveWriter), format is 'wav', 'rf64' or 'raw' (None = determined by the file extension).
         """
-        out = wave.open(filename, "wb")
-        out.setparams((first_sample.nchannels, first_sample.samplewidth, first_sample.samplerate, 0, "NONE", "not compressed"))
-        out.writeframesraw(first_sample.__frames)
+        out = BufferedWaveWriter(filename, first_sample.samplewidth, first_sample.samplerate,
+                                 first_sample.nchannels, format)
+        out.write(first_sample.__frames)
         return out
 
     @classmethod
     def wave_write_append(cls, out, sample):
         """Part of the sample stream output api: write more sample data to an open output stream."""
-        out.writeframesraw(sample.__frames)
+        out.write(sample.__frames)
 
     @classmethod
     def wave_write_end(cls, out):
         """Part of the sample stream output api: finalize and close the open output stream."""
-        out.writeframes(b"")  # make sure the updated header gets written
-        out.close()
+        out.close()    # writes the remaining data and the header
 
     def write_frames(self, stream):
         """Write the raw sample data to the output stream."""
@@ -278,41 +455,49 @@ class Sample:
         self.resample(self.norm_samplerate)
         if self.samplewidth != self.norm_samplewidth:
             # Convert to 16 bit sample size.
-            self.__frames = audioop.lin2lin(self.__frames, self.samplewidth, self.norm_samplewidth)
+            self.__pointwise(("lin2lin", self.samplewidth, self.norm_samplewidth))
             self.__samplewidth = self.norm_samplewidth
-        if self.nchannels == 1:
-            # convert to stereo
-            self.__frames = audioop.tostereo(self.__frames, self.samplewidth, 1, 1)
-            self.__nchannels = 2
+        if self.nchannels != self.norm_nchannels:
+            # convert to stereo (or the default number of channels)
+            self.__remix(Sample.channel_matrix(self.nchannels, self.norm_nchannels))
         return self
 
-    def resample(self, samplerate):
+    def resample(self, samplerate, quality=None):
         """
         Resamples to a different sample rate, without changing the pitch and duration of the sound.
-        The algorithm used is simple, and it will cause a loss of sound quality.
+        If numpy is available, a high quality polyphase filter is used, otherwise simple linear interpolation.
+        The quality parameter overrides the default resample_quality ('linear', 'low', 'medium' or 'high').
         """
         assert not self.__locked
         if samplerate == self.__samplerate:
             return self
-        self.__frames = audioop.ratecv(self.__frames, self.samplewidth, self.nchannels, self.samplerate, samplerate, None)[0]
+        self.__ratecv(self.samplerate, samplerate, quality)
         self.__samplerate = samplerate
         return self
 
-    def speed(self, speed):
+    def speed(self, speed, quality=None):
         """
         Changes the playback speed of the sample, without changing the sample rate.
         This will change the pitch and duration of the sound accordingly.
-        The algorithm used is simple, and it will cause a loss of sound quality.
+        The quality parameter works the same as with resample().
         """
         assert not self.__locked
         assert speed > 0
         if speed == 1.0:
             return self
-        rate = self.samplerate
-        self.__frames = audioop.ratecv(self.__frames, self.samplewidth, self.nchannels, int(self.samplerate*speed), rate, None)[0]
-        self.__samplerate = rate
+        self.__ratecv(int(self.samplerate*speed), self.samplerate, quality)
         return self
 
+    def __ratecv(self, inrate, outrate, quality):
+        quality = quality or self.resample_quality
+        if quality == "linear" or numpy is None:
+            self.__frames = dsp.ratecv(self.__frames, self.samplewidth, self.nchannels, inrate, outrate, None)[0]
+        elif self.__lazy:
+            self.__lazy_plan().resample(inrate, outrate, quality)
+        else:
+            from .resampler import resample
+            self.__frames = resample(self.__frames, self.samplewidth, self.nchannels, inrate, outrate, quality)
+
     def make_32bit(self, scale_amplitude=True):
         """
         Convert to 32 bit integer sample width, usually also scaling the amplitude to fit in the new 32 bits range.
@@ -321,7 +506,12 @@ class Sample:
         Usually after mixing you will convert back to 16 bits using maximized amplitude to have no quality loss.
         """
         assert not self.__locked
-        self.__frames = self.get_32bit_frames(scale_amplitude)
+        if self.samplewidth != 4:
+            width = self.samplewidth
+            self.__pointwise(("lin2lin", width, 4))
+            if not scale_amplitude:
+                # we need to scale back the sample amplitude to fit back into 24/16/8 bit range
+                self.__pointwise(("mul", 4, 1.0/2**(8*abs(width-4))))
         self.__samplewidth = 4
         return self
 
@@ -329,11 +519,11 @@ class Sample:
         """Returns the raw sample frames scaled to 32 bits. See make_32bit method for more info."""
         if self.samplewidth == 4:
             return self.__frames
-        frames = audioop.lin2lin(self.__frames, self.samplewidth, 4)
+        frames = dsp.lin2lin(self.__frames, self.samplewidth, 4)
         if not scale_amplitude:
             # we need to scale back the sample amplitude to fit back into 24/16/8 bit range
             factor = 1.0/2**(8*abs(self.samplewidth-4))
-            frames = audioop.mul(frames, 4, factor)
+            frames = dsp.mul(frames, 4, factor)
         return frames
 
     def make_16bit(self, maximize_amplitude=True):
@@ -347,24 +537,24 @@ class Sample:
         if maximize_amplitude:
             self.amplify_max()
         if self.samplewidth > 2:
-            self.__frames = audioop.lin2lin(self.__frames, self.samplewidth, 2)
+            self.__pointwise(("lin2lin", self.samplewidth, 2))
             self.__samplewidth = 2
         return self
 
     def amplify_max(self):
         """Amplify the sample to maximum volume without clipping or overflow happening."""
         assert not self.__locked
-        max_amp = audioop.max(self.__frames, self.samplewidth)
+        max_amp = dsp.max(self.__frames, self.samplewidth)
         max_target = 2 ** (8 * self.samplewidth - 1) - 2
         if max_amp > 0:
             factor = max_target/max_amp
-            self.__frames = audioop.mul(self.__frames, self.samplewidth, factor)
+            self.__frames = dsp.mul(self.__frames, self.samplewidth, factor)
         return self
 
     def amplify(self, factor):
         """Amplifies (multiplies) the sample by the given factor. May cause clipping/overflow if factor is too large."""
         assert not self.__locked
-        self.__frames = audioop.mul(self.__frames, self.samplewidth, factor)
+        self.__pointwise(("mul", self.samplewidth, factor))
         return self
 
     def at_volume(self, volume):
@@ -382,6 +572,9 @@ class Sample:
         """Keep only a given clip from the sample."""
         assert not self.__locked
         assert end_seconds > start_seconds
+        if self.__lazy and start_seconds >= 0:
+            self.__lazy_plan().clip(int(self.samplerate*start_seconds), int(self.samplerate*end_seconds))
+            return self
         start = self.frame_idx(start_seconds)
         end = self.frame_idx(end_seconds)
         self.__frames = self.__frames[start:end]
@@ -399,7 +592,10 @@ class Sample:
         return Sample.from_raw_frames(b"", self.__samplewidth, self.__samplerate, self.__nchannels)
 
     def add_silence(self, seconds, at_start=False):
-        """Add silence at the end (or at the start)"""
+        """
+        Add silence at the end (or at the start)
+        (To build a long sample from many pieces, use a SampleBuilder instead, that is a lot faster)
+        """
         assert not self.__locked
         required_extra = self.frame_idx(seconds)
         if at_start:
@@ -409,7 +605,10 @@ class Sample:
         return self
 
     def join(self, other):
-        """Add another sample at the end of the current one. The other sample must have the same properties."""
+        """
+        Add another sample at the end of the current one. The other sample must have the same properties.
+        (To build a long sample from many pieces, use a SampleBuilder instead, that is a lot faster)
+        """
         assert not self.__locked
         assert self.samplewidth == other.samplewidth
         assert self.samplerate == other.samplerate
@@ -421,37 +620,21 @@ class Sample:
         """Fade the end of the sample out to the target volume (usually zero) in the given time."""
         assert not self.__locked
         seconds = min(seconds, self.duration)
-        i = self.frame_idx(self.duration-seconds)
-        begin = self.__frames[:i]
-        end = self.__frames[i:]  # we fade this chunk
-        numsamples = len(end)/self.__samplewidth
-        decrease = 1.0-target_volume
-        _sw = self.__samplewidth     # optimization
-        _getsample = audioop.getsample   # optimization
-        faded = Sample.get_array(_sw, [int(_getsample(end, _sw, i)*(1.0-i*decrease/numsamples)) for i in range(int(numsamples))])
-        end = faded.tobytes()
-        if sys.byteorder == "big":
-            end = audioop.byteswap(end, self.__samplewidth)
-        self.__frames = begin + end
+        first_frame = int(self.samplerate*(self.duration-seconds))
+        num_frames = len(self) - first_frame
+        if num_frames > 0:
+            decrease = (1.0-target_volume)/num_frames
+            self.__apply_gain(_linear_gain(1.0, -decrease, num_frames), first_frame)
         return self
 
     def fadein(self, seconds, start_volume=0.0):
         """Fade the start of the sample in from the starting volume (usually zero) in the given time."""
         assert not self.__locked
         seconds = min(seconds, self.duration)
-        i = self.frame_idx(seconds)
-        begin = self.__frames[:i]  # we fade this chunk
-        end = self.__frames[i:]
-        numsamples = len(begin)/self.__samplewidth
-        increase = 1.0-start_volume
-        _sw = self.__samplewidth     # optimization
-        _getsample = audioop.getsample   # optimization
-        _incr = increase/numsamples    # optimization
-        faded = Sample.get_array(_sw, [int(_getsample(begin, _sw, i)*(i*_incr+start_volume)) for i in range(int(numsamples))])
-        begin = faded.tobytes()
-        if sys.byteorder == "big":
-            begin = audioop.byteswap(begin, self.__samplewidth)
-        self.__frames = begin + end
+        num_frames = int(self.samplerate*seconds)
+        if num_frames > 0:
+            increase = (1.0-start_volume)/num_frames
+            self.__apply_gain(_linear_gain(start_volume, increase, num_frames), 0)
         return self
 
     def modulate_amp(self, modulator):
@@ -460,28 +643,24 @@ class Sample:
         You can use a Sample (or array of sample values) or an oscillator as modulator.
         If you use a Sample (or array), it will be cycled if needed and its maximum amplitude
         is scaled to be 1.0, effectively using it as if it was an oscillator.
+        The modulation is applied per frame, so all channels get the same amplitude.
         """
         assert not self.__locked
-        frames = self.get_frame_array()
-        if isinstance(modulator, (Sample, list, array.array)):
-            # modulator is a waveform, turn that into an 'oscillator' ran
-            if isinstance(modulator, Sample):
-                modulator = modulator.get_frame_array()
-            biggest = max(max(modulator), abs(min(modulator)))
-            modulator = (v/biggest for v in itertools.cycle(modulator))
-        else:
-            modulator = iter(modulator)
-        for i in range(len(frames)):
-            frames[i] = int(frames[i] * next(modulator))
-        self.__frames = frames.tobytes()
-        if sys.byteorder == "big":
-            self.__frames = audioop.byteswap(self.__frames, self.__samplewidth)
+        self.__apply_gain(_modulator_values(modulator, len(self)), 0)
         return self
 
+    def __apply_gain(self, gains, first_frame):
+        """
+        Multiply the frames starting at first_frame with the given gain curve (one gain per frame,
+        or one tuple of gains per frame that has a separate gain for every channel).
+        Values that would overflow the sample width are clipped.
+        """
+        self.__pointwise(("gain", self.__samplewidth, self.__nchannels, first_frame, gains))
+
     def reverse(self):
         """Reverse the sound."""
         assert not self.__locked
-        self.__frames = audioop.reverse(self.__frames, self.__samplewidth)
+        self.__frames = dsp.reverse(self.__frames, self.__samplewidth)
         return self
 
     def invert(self):
@@ -518,7 +697,24 @@ class Sample:
     def bias(self, bias):
         """Add a bias constant to each sample value."""
         assert not self.__locked
-        self.__frames = audioop.bias(self.__frames, self.__samplewidth, bias)
+        self.__frames = dsp.bias(self.__frames, self.__samplewidth, bias)
+        return self
+
+    def remix(self, matrix):
+        """
+        Mixes the channels into a new set of channels, using a channel matrix. It has a row for every new
+        channel, containing the factor for every current channel. So it can route channels to other
+        speakers, or up-mix and down-mix any number of channels, in one pass over the sample data.
+        Instead of a matrix you can also give the new number of channels, see channel_matrix for how
+        the channels are then up-mixed or down-mixed.
+        """
+        assert not self.__locked
+        if isinstance(matrix, int):
+            matrix = Sample.channel_matrix(self.__nchannels, matrix)
+        matrix = [list(row) for row in matrix]
+        if not matrix or any(len(row) != self.__nchannels for row in matrix):
+            raise ValueError("channel matrix must have a row for every new channel, with one factor per channel")
+        self.__remix(matrix)
         return self
 
     def mono(self, left_factor=1.0, right_factor=1.0):
@@ -527,10 +723,9 @@ class Sample:
         if self.__nchannels == 1:
             return self
         if self.__nchannels == 2:
-            self.__frames = audioop.tomono(self.__frames, self.__samplewidth, left_factor, right_factor)
-            self.__nchannels = 1
+            self.__remix([[left_factor, right_factor]])
             return self
-        raise ValueError("sample must be stereo or mono already")
+        raise ValueError("sample must be stereo or mono already (use remix for more channels)")
 
     def left(self):
         """Only keeps left channel."""
@@ -553,15 +748,12 @@ class Sample:
         """
         assert not self.__locked
         if self.__nchannels == 2:
-            # first split the left and right channels and then remix them
-            right = self.copy().right()
-            self.left().amplify(left_factor)
-            return self.stereo_mix(right, 'R', right_factor)
+            self.__remix([[left_factor, 0], [0, right_factor]])
+            return self
         if self.__nchannels == 1:
-            self.__frames = audioop.tostereo(self.__frames, self.__samplewidth, left_factor, right_factor)
-            self.__nchannels = 2
+            self.__remix([[left_factor], [right_factor]])
             return self
-        raise ValueError("sample must be mono or stereo already")
+        raise ValueError("sample must be mono or stereo already (use remix for more channels)")
 
     def stereo_mix(self, other, other_channel, other_mix_factor=1.0, mix_at=0.0, other_seconds=None):
         """
@@ -592,30 +784,21 @@ class Sample:
         """
         Linear Stereo panning, -1 = full left, 1 = full right.
         If you provide a LFO that will be used for panning instead.
+        Just like with modulate_amp, the LFO can also be a Sample or array of sample values.
         """
         assert not self.__locked
-        if not lfo:
+        if self.__nchannels > 2:
+            raise ValueError("sample must be mono or stereo already (use remix for more channels)")
+        if lfo is None:
             return self.stereo((1-panning)/2, (1+panning)/2)
-        lfo = iter(lfo)
-        if self.__nchannels == 2:
-            right = self.copy().right().get_frame_array()
-            left = self.copy().left().get_frame_array()
-            stereo = self.get_frame_array()
-            for i in range(len(right)):
-                panning = next(lfo)
-                left_s = left[i]*(1-panning)/2
-                right_s = right[i]*(1+panning)/2
-                stereo[i*2] = int(left_s)
-                stereo[i*2+1] = int(right_s)
+        panning = _modulator_values(lfo, len(self))
+        if self.__nchannels == 1:
+            self.__remix([[1], [1]])
+        if numpy:
+            gains = numpy.column_stack(((1-panning)/2, (1+panning)/2))
         else:
-            mono = self.get_frame_array()
-            stereo = mono+mono
-            for i, sample in enumerate(mono):
-                panning = next(lfo)
-                stereo[i*2] = int(sample*(1-panning)/2)
-                stereo[i*2+1] = int(sample*(1+panning)/2)
-            self.__nchannels = 2
-        self.__frames = Sample.from_array(stereo, self.__samplerate, 2).__frames
+            gains = [((1-p)/2, (1+p)/2) for p in panning]
+        self.__apply_gain(gains, 0)
         return self
 
     def echo(self, length, amount, delay, decay):
@@ -626,7 +809,32 @@ class Sample:
         If you use a very short delay the echos blend into the sound and the effect is more like a reverb.
         """
         assert not self.__locked
-        if amount > 0:
+        if amount > 0 and numpy is not None:
+            # the echos form a sparse impulse response, that is convolved with the end of the sample in one go
+            from .convolver import convolve
+            framesize = self.samplewidth*self.nchannels
+            start = max(0, self.duration - length)
+            offsets = []
+            gains = []
+            echo_amp = decay
+            gain = 1.0
+            position = start
+            for _ in range(amount):
+                if echo_amp < 1.0/(2**(8*self.__samplewidth-1)):
+                    # avoid computing echos that you can't hear
+                    break
+                position += delay
+                gain *= echo_amp     # every echo is an amplified copy of the previous echo
+                offsets.append((self.frame_idx(position)-self.frame_idx(start)) // framesize)
+                gains.append(gain)
+                echo_amp *= decay
+            if offsets:
+                impulse_response = numpy.zeros(offsets[-1]+1)
+                impulse_response[offsets] = gains
+                tail = self.__frames[self.frame_idx(start):]
+                frames = convolve(tail, impulse_response, self.samplewidth, self.nchannels)
+                self.mix_at(start, Sample.from_raw_frames(frames, self.samplewidth, self.samplerate, self.nchannels))
+        elif amount > 0:
             length = max(0, self.duration - length)
             echo = self.copy()
             echo.__frames = self.__frames[self.frame_idx(length):]
@@ -641,23 +849,78 @@ class Sample:
                 echo_amp *= decay
         return self
 
-    def envelope(self, attack, decay, sustainlevel, release):
-        """Apply an ADSR volume envelope. A,D,R are in seconds, Sustainlevel is a factor."""
+    def reverb(self, impulse_response, wet=0.5, dry=1.0):
+        """
+        Convolution reverb: convolves the sample with the impulse response (a Sample, such as a recorded room response).
+        The impulse response is normalized, wet and dry are the volume factors of the reverb and the original sound.
+        The sample is extended with the reverb tail. Requires numpy.
+        """
+        assert not self.__locked
+        if numpy is None:
+            raise RuntimeError("reverb requires numpy")
+        from .convolver import convolve, reverb_kernel
+        kernel = reverb_kernel(impulse_response, self.samplerate, self.nchannels, wet, dry)
+        self.__frames = convolve(self.__frames, kernel, self.samplewidth, self.nchannels)
+        return self
+
+    def time_stretch(self, factor):
+        """
+        Changes the duration by the given factor (2.0 = twice as long, so half the tempo),
+        without changing the pitch. This is done with WSOLA (see the timestretch module). Requires numpy.
+        """
+        assert not self.__locked
+        assert factor > 0
+        if numpy is None:
+            raise RuntimeError("time stretching requires numpy")
+        if factor != 1.0:
+            from .timestretch import time_stretch
+            self.__frames = time_stretch(self.__frames, self.samplewidth, self.nchannels, self.samplerate, factor)
+        return self
+
+    def pitch_shift(self, semitones, quality=None):
+        """
+        Changes the pitch by the given number of semitones (can be fractional or negative),
+        without changing the duration: the sample is time stretched and then sped up or slowed down.
+        The quality parameter works the same as with resample(). Requires numpy.
+        """
+        assert not self.__locked
+        if semitones:
+            nframes = len(self)
+            ratio = 2 ** (semitones / 12)
+            self.time_stretch(ratio).speed(ratio, quality)
+            # correct the rounding of the two duration changes, to end up with the original number of frames
+            frames = self.__frames[:nframes * self.samplewidth * self.nchannels]
+            self.__frames = frames + b"\0" * (nframes * self.samplewidth * self.nchannels - len(frames))
+        return self
+
+    def envelope(self, attack, decay, sustainlevel, release, curve="linear"):
+        """
+        Apply an ADSR volume envelope. A,D,R are in seconds, Sustainlevel is a factor.
+        The curve shape of the A,D,R segments is 'linear', 'exponential' (like an analog synthesizer envelope),
+        or a function that maps the progress (0..1) within a segment to the progress of the volume change.
+        The whole envelope is applied as a single gain curve, in one pass over the sample.
+        """
         assert not self.__locked
         assert attack >= 0 and decay >= 0 and release >= 0
         assert 0 <= sustainlevel <= 1
-        D = self.split(attack)   # self = A
-        S = D.split(decay)
-        if sustainlevel < 1:
-            S.amplify(sustainlevel)   # apply the sustain level to S now so that R gets it as well
-        R = S.split(S.duration - release)
-        if attack > 0:
-            self.fadein(attack)
-        if decay > 0:
-            D.fadeout(decay, sustainlevel)
-        if release > 0:
-            R.fadeout(release)
-        self.join(D).join(S).join(R)
+        if curve in _envelope_curves:
+            curve = _envelope_curves[curve]
+        elif not callable(curve):
+            raise ValueError("invalid envelope curve, choose one of: " + ", ".join(_envelope_curves))
+        num_frames = len(self)
+        attack = min(num_frames, int(self.samplerate*attack))
+        decay = min(num_frames-attack, int(self.samplerate*decay))
+        release = min(num_frames-attack-decay, int(self.samplerate*release))
+        sustain = num_frames-attack-decay-release
+        segments = [(0.0, 1.0, attack), (1.0, sustainlevel, decay), (sustainlevel, sustainlevel, sustain),
+                    (sustainlevel, 0.0, release)]
+        if numpy:
+            gains = numpy.concatenate([start+(end-start)*curve(numpy.arange(count)/count)
+                                       for start, end, count in segments if count])
+        else:
+            gains = [start+(end-start)*curve(i/count) for start, end, count in segments for i in range(count)]
+        if len(gains):
+            self.__apply_gain(gains, 0)
         return self
 
     def mix(self, other, other_seconds=None, pad_shortest=True):
@@ -676,11 +939,12 @@ class Sample:
         else:
             frames2 = other.__frames
         if pad_shortest:
+            # (the frames can be a memoryview, such as for a chunk from iter_chunks)
             if len(frames1) < len(frames2):
-                frames1 += b"\0"*(len(frames2)-len(frames1))
+                frames1 = bytes(frames1) + b"\0"*(len(frames2)-len(frames1))
             elif len(frames2) < len(frames1):
-                frames2 += b"\0"*(len(frames1)-len(frames2))
-        self.__frames = audioop.add(frames1, frames2, self.samplewidth)
+                frames2 = bytes(frames2) + b"\0"*(len(frames1)-len(frames2))
+        self.__frames = dsp.add(frames1, frames2, self.samplewidth)
         return self
 
     def mix_at(self, seconds, other, other_seconds=None):
@@ -699,10 +963,10 @@ class Sample:
             other_frames = other.__frames[:other.frame_idx(other_seconds)]
         else:
             other_frames = other.__frames
-        # Mix the frames. Unfortunately audioop requires splitting and copying the sample data, which is slow.
+        # Mix the frames. Unfortunately dsp.add requires splitting and copying the sample data, which is slow.
         pre, to_mix, post = self._mix_split_frames(len(other_frames), start_frame_idx)
         self.__frames = None  # allow for garbage collection
-        mixed = audioop.add(to_mix, other_frames, self.samplewidth)
+        mixed = dsp.add(to_mix, other_frames, self.samplewidth)
         del to_mix  # more garbage collection
         self.__frames = self._mix_join_frames(pre, mixed, post)
         return self
@@ -727,6 +991,287 @@ class Sample:
             self.__frames += b"\0" * (required_length - len(self.__frames))
 
 
+def _linear_gain(start, increment, num_frames):
+    """Returns a linearly sloped gain curve of the given number of frames."""
+    if numpy:
+        return start + numpy.arange(num_frames) * increment
+    return [start + i*increment for i in range(num_frames)]
+
+
+def _exponential_curve(progress):
+    # fast initial change that gradually slows down, like the charging or discharging of a capacitor
+    if numpy:
+        return (1.0-numpy.exp(-5.0*progress)) / (1.0-math.exp(-5.0))
+    return (1.0-math.exp(-5.0*progress)) / (1.0-math.exp(-5.0))
+
+
+_envelope_curves = {
+    "linear": lambda progress: progress,
+    "exponential": _exponential_curve
+}
+
+
+def _modulator_values(modulator, count):
+    """
+    Returns a block of 'count' values taken from the modulator.
+    A modulator can be a Sample or an array of sample values (that will be cycled if needed,
+    and scaled to a maximum amplitude of 1.0), or an oscillator. Oscillators that can produce
+    their values in blocks are asked for a whole block at once, other iterables are consumed
+    value by value.
+    """
+    if isinstance(modulator, Sample):
+        if numpy:
+            modulator = dsp.unpack(modulator.view_frame_data(), modulator.samplewidth)
+        else:
+            modulator = modulator.get_frame_array()
+    if isinstance(modulator, (list, array.array)) or (numpy and isinstance(modulator, numpy.ndarray)):
+        if numpy:
+            waveform = numpy.asarray(modulator, dtype=float)
+            biggest = numpy.abs(waveform).max()
+            return numpy.resize(waveform/biggest, count)
+        biggest = max(max(modulator), abs(min(modulator)))
+        return [v/biggest for v in itertools.islice(itertools.cycle(modulator), count)]
+    if hasattr(modulator, "blocks"):
+        values = next(modulator.blocks(count))
+        return numpy.asarray(values, dtype=float) if numpy else list(values)
+    values = itertools.islice(iter(modulator), count)
+    return numpy.fromiter(values, dtype=float, count=count) if numpy else list(values)
+
+
+# the standard speaker layouts per number of channels, in the default channel order of wav files
+_speaker_layouts = {
+    1: ["C"],
+    2: ["L", "R"],
+    3: ["L", "R", "C"],
+    4: ["L", "R", "Ls", "Rs"],
+    5: ["L", "R", "C", "Ls", "Rs"],
+    6: ["L", "R", "C", "LFE", "Ls", "Rs"],
+    7: ["L", "R", "C", "LFE", "Cs", "Ls", "Rs"],
+    8: ["L", "R", "C", "LFE", "Lb", "Rb", "Ls", "Rs"],
+}
+
+# how a speaker that isn't in the layout is folded into the other speakers, with the factors of ITU-R BS.775
+_speaker_folds = {
+    "C": [("L", 0.7071), ("R", 0.7071)],
+    "LFE": [],          # the low frequency effects channel is left out of a down-mix
+    "Cs": [("Ls", 0.7071), ("Rs", 0.7071)],
+    "Ls": [("L", 0.7071)],
+    "Rs": [("R", 0.7071)],
+    "Lb": [("Ls", 1.0)],
+    "Rb": [("Rs", 1.0)],
+}
+
+
+def _channel_selection(channel, nchannels):
+    """The channel matrix row that selects a single channel."""
+    return [1 if c == channel else 0 for c in range(nchannels)]
+
+
+def _pointwise_op(operation, frames, first_frame):
+    """
+    Performs a frame-wise operation on the frames (that start at the given frame index in the sample).
+    The operations are tuples: (lin2lin, width, newwidth), (remix, width, nchannels, channel matrix),
+    (mul, width, factor), or (gain, width, nchannels, first frame, gains) to apply a gain curve to part of the sample.
+    """
+    kind = operation[0]
+    if kind == "lin2lin":
+        return dsp.lin2lin(frames, operation[1], operation[2])
+    if kind == "remix":
+        return dsp.remix(frames, operation[1], operation[2], operation[3])
+    if kind == "mul":
+        return dsp.mul(frames, operation[1], operation[2])
+    if kind == "gain":
+        _, width, nchannels, gain_start, gains = operation
+        frame_size = width*nchannels
+        begin = max(gain_start, first_frame)
+        end = min(gain_start+len(gains), first_frame+len(frames)//frame_size)
+        if begin >= end:
+            return frames
+        start = (begin-first_frame)*frame_size
+        stop = (end-first_frame)*frame_size
+        faded = dsp.gain(memoryview(frames)[start:stop], width, nchannels, gains[begin-gain_start:end-gain_start])
+        if start == 0 and stop == len(frames):
+            return faded
+        # only the faded part is processed, the block is assembled with a single copy
+        return b"".join((memoryview(frames)[:start], faded, memoryview(frames)[stop:]))
+    raise ValueError("invalid operation: " + str(kind))
+
+
+class _LazyPlan:
+    """
+    The operations that are recorded for a Sample in lazy mode. They're executed in a single pass,
+    block by block, through a chain of generators that produce (first frame index, frames) tuples.
+    """
+    block_frames = 65536
+
+    def __init__(self, frames, samplewidth, nchannels):
+        self.source = frames
+        self.source_frame_size = samplewidth * nchannels
+        self.samplewidth = samplewidth
+        self.nchannels = nchannels
+        self.nframes = len(frames) // samplewidth // nchannels
+        self.operations = []    # tuples of (operation, number of input frames)
+
+    def clip(self, start, end):
+        start = min(start, self.nframes)
+        end = max(start, min(end, self.nframes))
+        self.operations.append((("clip", start, end), self.nframes))
+        self.nframes = end - start
+
+    def resample(self, inrate, outrate, quality):
+        operation = ("resample", inrate, outrate, quality, self.samplewidth, self.nchannels)
+        self.operations.append((operation, self.nframes))
+        self.nframes = -(-self.nframes*outrate // inrate)
+
+    def pointwise(self, operation):
+        self.operations.append((operation, self.nframes))
+        if operation[0] == "lin2lin":
+            self.samplewidth = operation[2]
+        elif operation[0] == "remix":
+            self.nchannels = len(operation[3])
+
+    def execute(self):
+        if not self.nframes:
+            return b""
+        # work backwards to find the range of frames that every operation needs to produce
+        needed = (0, self.nframes)
+        ranges = [needed]
+        for operation, nframes in reversed(self.operations):
+            if operation[0] == "clip":
+                needed = (needed[0]+operation[1], needed[1]+operation[1])
+            elif operation[0] == "resample":
+                needed = _resample_input_range(operation, needed, nframes)
+            ranges.append(needed)
+        ranges.reverse()
+        # chain the operations, starting from the needed part of the source frames
+        blocks = _source_blocks(self.source, self.source_frame_size, needed[0], needed[1], self.block_frames)
+        for (operation, _), input_range, output_range in zip(self.operations, ranges, ranges[1:]):
+            if operation[0] == "clip":
+                blocks = _shifted_blocks(blocks, operation[1])
+            elif operation[0] == "resample":
+                blocks = _resampled_blocks(blocks, operation, input_range[0], output_range)
+            else:
+                blocks = _pointwise_blocks(blocks, operation)
+        return b"".join(frames for _, frames in blocks)
+
+
+def _resample_input_range(operation, needed, nframes):
+    # Range of input frames needed to compute the given output range of a resample operation exactly.
+    # It starts at a multiple of the rate ratio's denominator, so the output positions stay the same.
+    from .resampler import Resampler
+    resampler = Resampler(operation[1], operation[2], operation[4], operation[5], operation[3])
+    lowest = max(0, (needed[0]*resampler.down) // resampler.up - resampler.half_taps - 2)
+    highest = ((needed[1]-1)*resampler.down) // resampler.up + resampler.half_taps + 3
+    return lowest // resampler.down * resampler.down, min(nframes, highest)
+
+
+def _source_blocks(frames, frame_size, start, end, block_frames):
+    for first in range(start, end, block_frames):
+        yield first, frames[first*frame_size:min(first+block_frames, end)*frame_size]
+
+
+def _shifted_blocks(blocks, offset):
+    for first, frames in blocks:
+        yield first-offset, frames
+
+
+def _pointwise_blocks(blocks, operation):
+    for first, frames in blocks:
+        yield first, _pointwise_op(operation, frames, first)
+
+
+def _resampled_blocks(blocks, operation, input_start, output_range):
+    from .resampler import Resampler
+    _, inrate, outrate, quality, width, nchannels = operation
+    resampler = Resampler(inrate, outrate, width, nchannels, quality)
+    frame_size = width*nchannels
+    position = input_start * resampler.up // resampler.down
+    begin, end = output_range
+    for _, frames in itertools.chain(blocks, [(None, None)]):
+        frames = resampler.process(frames) if frames is not None else resampler.flush()
+        count = len(frames) // frame_size
+        if position+count > begin:
+            start = max(0, begin-position)
+            stop = min(count, end-position)
+            yield position+start, frames[start*frame_size:stop*frame_size]
+        position += count
+        if position >= end:
+            return
+
+
+class SampleBuilder:
+    """
+    Builds a (long) sample out of many pieces: samples that are appended or mixed in, and silence.
+    Sample.join, add_silence and mix_at have to copy the whole sample data every time,
+    but the builder collects everything in a single growable buffer, so building is done in linear time.
+    The sample is created only once at the end, with build().
+    """
+    def __init__(self, samplewidth=Sample.norm_samplewidth, samplerate=Sample.norm_samplerate,
+                 nchannels=Sample.norm_nchannels):
+        self.samplewidth = samplewidth
+        self.samplerate = samplerate
+        self.nchannels = nchannels
+        self._frame_size = samplewidth * nchannels
+        self._buffer = bytearray()
+
+    def __len__(self):
+        """returns the number of sample frames"""
+        return len(self._buffer) // self._frame_size
+
+    @property
+    def duration(self):
+        return len(self) / self.samplerate
+
+    def _check_params(self, sample):
+        assert self.samplewidth == sample.samplewidth
+        assert self.samplerate == sample.samplerate
+        assert self.nchannels == sample.nchannels
+
+    def append(self, sample):
+        """Add a sample at the end. It must have the same properties as the builder."""
+        self._check_params(sample)
+        self._buffer += sample.view_frame_data()
+        return self
+
+    def append_frames(self, frames):
+        """Add raw sample frames at the end."""
+        self._buffer += frames
+        return self
+
+    def add_silence(self, seconds):
+        """Add silence at the end."""
+        self._buffer += bytes(self._frame_size * int(self.samplerate*seconds))
+        return self
+
+    def mix_at(self, seconds, sample):
+        """Mix a sample in at a specific time point, growing the buffer if needed. Values are clipped on overflow."""
+        self._check_params(sample)
+        start = self._frame_size * int(self.samplerate*seconds)
+        frames = sample.view_frame_data()
+        end = start + len(frames)
+        if end > len(self._buffer):
+            self._buffer += bytes(end - len(self._buffer))
+        self._buffer[start:end] = dsp.add(self._buffer[start:end], frames, self.samplewidth)
+        return self
+
+    def truncate(self, seconds):
+        """Cut off everything after the given time point."""
+        del self._buffer[self._frame_size * int(self.samplerate*seconds):]
+        return self
+
+    def view_frame_data(self):
+        """Directly returns a (flat, writable) view on the raw frames data that is built so far, without copying it."""
+        return memoryview(self._buffer)
+
+    def write_frames(self, stream):
+        """Write the raw sample data to the output stream."""
+        stream.write(self._buffer)
+
+    def build(self):
+        """Returns a new Sample containing everything that has been built."""
+        return Sample.from_raw_frames(bytes(self._buffer), self.samplewidth, self.samplerate, self.nchannels)
+
+
 # noinspection PyAttributeOutsideInit
 class LevelMeter:
     """
@@ -734,18 +1279,25 @@ class LevelMeter:
     It has state, because it keeps track of the peak levels as well over time.
     The peaks eventually decay slowly if the actual level is decreased.
     """
-    def __init__(self, rms_mode=False, lowest=-60.0):
+    def __init__(self, rms_mode=False, lowest=-60.0, decimation=1, history_frames=0):
         """
         Creates a new Level meter.
         Rms mode means that instead of peak volume, RMS volume will be used.
+        A decimation factor makes it only look at every n-th frame, which makes it much cheaper.
+        If history_frames is given, the history attribute is updated with the minimum and maximum
+        values per that number of frames of every channel (see Sample.level_history), for waveform displays.
         """
         assert -60.0 <= lowest < 0.0
+        assert decimation >= 1
         self._rms = rms_mode
         self._lowest = lowest
+        self._decimation = decimation
+        self._history_frames = history_frames
         self.reset()
 
     def reset(self):
         """Resets the meter to its initial state with lowest levels."""
+        self.history = []
         self.peak_left = self.peak_right = self._lowest
         self._peak_left_hold = self._peak_right_hold = 0.0
         self.level_left = self.level_right = self._lowest
@@ -758,10 +1310,10 @@ class LevelMeter:
         It will update the level meter's state, but for convenience also returns
         the left, peakleft, right, peakright levels as a tuple.
         """
-        if self._rms:
-            left, right = sample.level_db_rms
-        else:
-            left, right = sample.level_db_peak
+        levels = sample.level_db_channels(self._rms, self._decimation)
+        left, right = levels[0], levels[min(1, len(levels)-1)]
+        if self._history_frames:
+            self.history = sample.level_history(self._history_frames)
         left = max(left, self._lowest)
         right = max(right, self._lowest)
         time = self._time + sample.duration
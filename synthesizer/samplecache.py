@@ -0,0 +1,89 @@
+"""
+On-disk cache of normalized instrument samples. Loading a sample file and normalizing it
+(resampling, channel conversion, making it 32 bits) takes time, so the result is stored in a
+cache file, keyed by the path and modification time of the sample file, the target format and
+the resampling method. The next time, the cache file is simply memory mapped.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import os
+import mmap
+import hashlib
+import tempfile
+import threading
+try:
+    import appdirs
+except ImportError:
+    appdirs = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from .sample import Sample
+
+
+__all__ = ["SampleCache"]
+
+
+class SampleCache:
+    """
+    Loads normalized 32 bits instrument samples (like Song.read_samples uses them) via a cache directory.
+    If you don't give a directory, the user's cache directory is used (requires appdirs, otherwise
+    a directory in the temp folder is used). If the cache can't be written, the samples are loaded normally.
+    """
+    version = 3     # increase this when the normalization changes, to invalidate the existing cache files
+
+    def __init__(self, directory=None):
+        if directory is None:
+            if appdirs:
+                directory = appdirs.user_cache_dir("synthesizer", "Razorvine")
+            else:
+                directory = os.path.join(tempfile.gettempdir(), "synthesizer-cache")
+        self.directory = directory
+
+    def cache_filename(self, filename, extension=".raw"):
+        """Returns the name of the cache file for the given (sample) file."""
+        stat = os.stat(filename)
+        # without numpy, samples are resampled with linear interpolation (see Sample.resample)
+        quality = Sample.resample_quality if numpy else "linear"
+        key = "{:d}:{:s}:{:d}:{:d}:{:d}:{:d}:{:d}:{:s}".format(self.version, os.path.abspath(filename),
+                                                               stat.st_mtime_ns, stat.st_size, Sample.norm_samplerate,
+                                                               Sample.norm_nchannels, 4, quality)
+        return os.path.join(self.directory, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + extension)
+
+    def load(self, filename):
+        """
+        Returns the normalized 32 bits sample for the sample file, from the cache if possible.
+        A sample from the cache is a view on the memory mapped cache file. The memory map isn't closed
+        explicitly: it stays open as long as the sample's frames are in use (interned samples are shared),
+        and it is unmapped when they are garbage collected.
+        """
+        cache_filename = self.cache_filename(filename)
+        try:
+            with open(cache_filename, "rb") as cache_file:
+                if os.fstat(cache_file.fileno()).st_size:
+                    frames = memoryview(mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ))
+                else:
+                    frames = b""
+        except FileNotFoundError:
+            sample = Sample(wave_file=filename).lazy().normalize().make_32bit(scale_amplitude=False)
+            self.store(cache_filename, lambda cache_file: cache_file.write(sample.view_frame_data()))
+            return sample
+        sample = Sample.from_raw_frames(frames, 4, Sample.norm_samplerate, Sample.norm_nchannels)
+        sample.filename = filename
+        return sample
+
+    def store(self, cache_filename, write):
+        """
+        Creates the cache file, by calling the write function with the opened file.
+        It's written to a temporary file first, so that another process never sees a partial cache file.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_filename = "{:s}.{:d}.{:d}.tmp".format(cache_filename, os.getpid(), threading.get_ident())
+            with open(temp_filename, "wb") as cache_file:
+                write(cache_file)
+            os.replace(temp_filename, cache_filename)
+        except OSError:
+            pass    # no cache then
@@ -11,12 +11,21 @@ import json
 import wave
 import os
 import io
+import struct
 import logging
 from functools import namedtuple
 from synthesizer.sample import Sample
+from synthesizer import dsp
+try:
+    from synthesizer.resampler import Resampler
+    from synthesizer.convolver import Convolver
+except ImportError:
+    Resampler = Convolver = None    # in-process resampling and convolution require numpy
 
 
-__all__ = ["AudiofileToWavStream", "StreamMixer", "VolumeFilter", "EndlessFramesFilter", "SampleStream"]
+__all__ = ["AudiofileToWavStream", "StreamMixer", "VolumeFilter", "EndlessFramesFilter", "SampleStream",
+           "StreamingResampler", "ResamplingWavStream", "ConvolutionFilter", "SampleWidthFilter",
+           "RemixFilter", "SampleChunkStream"]
 
 log = logging.getLogger("synthesizer.streaming")
 
@@ -29,6 +38,8 @@ class AudiofileToWavStream(io.RawIOBase):
     If the file is not already a .wav, and/or you want to resample it,
     ffmpeg/ffprobe are used to convert it in the background.
     For HQ resampling, ffmpeg has to be built with libsoxr support.
+    A .wav file that only has a different sample rate and/or integer sample format (8, 16, 24 or 32 bits)
+    is converted in-process instead (resampling requires numpy).
 
     Input: audio file of any supported format
     Output: stream of audio data in WAV PCM format
@@ -48,19 +59,33 @@ class AudiofileToWavStream(io.RawIOBase):
         self.downmix_options = []
         self.sampleformat_options = []
         self.conversion_required = True
+        self.resample_inprocess = False
         self.format_probe = None
         self._startfrom = startfrom
         self._duration = duration
-        if self.ffprobe_executable:
-            try:
-                # probe the existing file format, to see if we can avoid needless conversion
+        self._samplerate = samplerate
+        self._samplewidth = int(sampleformat)//8 if sampleformat and sampleformat.isdigit() else None
+        self._resample_quality = "high" if hqresample else "medium"
+        try:
+            # probe the existing file format, to see if we can avoid needless conversion
+            probe = self.probe_wav(self.filename)
+            if not probe and self.ffprobe_executable:
                 probe = self.probe_format(self.filename)
+            if probe:
                 self.conversion_required = probe.rate != samplerate or probe.channels != channels \
                                            or probe.sampformat != sampleformat or probe.fileformat != "wav" \
                                            or self._startfrom > 0 or self._duration > 0
                 self.format_probe = probe
-            except (subprocess.CalledProcessError, IOError, OSError):
-                pass
+                if self.conversion_required and (Resampler or not samplerate or probe.rate == samplerate):
+                    # a wav file that only has a different sample rate and/or sample format, doesn't need ffmpeg
+                    integer_formats = ("8", "16", "24", "32")
+                    self.resample_inprocess = probe.channels == channels and probe.fileformat == "wav" \
+                                              and probe.sampformat in integer_formats \
+                                              and (sampleformat in integer_formats or not sampleformat) \
+                                              and not self._startfrom and not self._duration
+                    self.conversion_required = not self.resample_inprocess
+        except (subprocess.CalledProcessError, IOError, OSError):
+            pass
         if self.conversion_required:
             if samplerate:
                 samplerate = int(samplerate)
@@ -93,6 +118,18 @@ class AudiofileToWavStream(io.RawIOBase):
         buildconf = subprocess.check_output([cls.ffmpeg_executable, "-v", "error", "-buildconf"]).decode()
         return "--enable-libsoxr" in buildconf
 
+    @classmethod
+    def probe_wav(cls, filename):
+        """Quickly probes a PCM .wav file without using ffprobe. Returns None if it's not such a file."""
+        try:
+            with wave.open(filename, "rb") as w:
+                result = AudioFormatProbe(w.getframerate(), w.getnchannels(), str(8*w.getsampwidth()),
+                                          "wav", w.getnframes()/w.getframerate())
+        except (wave.Error, EOFError):
+            return None
+        log.debug("wav probe of %s: %s", filename, result)
+        return result
+
     @classmethod
     def probe_format(cls, filename):
         command = [cls.ffprobe_executable, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", "-i", filename]
@@ -117,7 +154,15 @@ class AudiofileToWavStream(io.RawIOBase):
         return result
 
     def start_stream(self):
-        if not self.conversion_required:
+        if self.resample_inprocess:
+            log.debug("in-process conversion of %s", self.filename)
+            stream = ResamplingWavStream(self.filename, self._samplerate, self._resample_quality, self._samplewidth)
+            if self.outputfilename:
+                with stream, open(self.outputfilename, "wb") as dest:
+                    shutil.copyfileobj(stream, dest)
+                return
+            self.stream = stream
+        elif not self.conversion_required:
             if self.outputfilename:
                 log.debug("direct copy from %s to %s", self.filename, self.outputfilename)
                 with open(self.filename, "rb") as source:
@@ -163,10 +208,77 @@ class AudiofileToWavStream(io.RawIOBase):
             return True
 
 
+class ResamplingWavStream(io.RawIOBase):
+    """
+    Streams WAV PCM audio data from a .wav file, converted to another sample rate and/or sample width on the fly.
+    Resampling is done in-process by the polyphase resampler, so it requires numpy.
+    A samplerate or samplewidth of None keeps the one of the source file.
+    """
+    buffer_size = 16384     # number of frames read from the source file at a time
+
+    def __init__(self, filename, samplerate, quality="medium", samplewidth=None):
+        self.source = wave.open(filename, "rb")
+        self.source_samplewidth = self.source.getsampwidth()
+        self.samplewidth = samplewidth or self.source_samplewidth
+        self.nchannels = self.source.getnchannels()
+        rate = self.source.getframerate()
+        samplerate = int(samplerate or rate)
+        self.resampler = None
+        if samplerate != rate:
+            if not Resampler:
+                self.source.close()
+                raise RuntimeError("in-process resampling requires numpy")
+            self.resampler = Resampler(rate, samplerate, self.source_samplewidth, self.nchannels, quality)
+        # the resampler produces exactly this number of frames, so the wav header can be written upfront
+        nframes = -(-self.source.getnframes()*samplerate // rate)
+        datasize = nframes * self.nchannels * self.samplewidth
+        self._buffer = bytearray(struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36+datasize, b"WAVE", b"fmt ", 16, 1,
+                                             self.nchannels, samplerate, samplerate*self.nchannels*self.samplewidth,
+                                             self.nchannels*self.samplewidth, 8*self.samplewidth, b"data", datasize))
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            frames = self.source.readframes(self.buffer_size)
+            if self.source_samplewidth == 1:
+                frames = dsp.bias(frames, 1, 128)   # 8 bit wav data is unsigned, flip it to signed
+            if not self.resampler:
+                self._finished = not frames
+            elif frames:
+                frames = self.resampler.process(frames)
+            else:
+                frames = self.resampler.flush()
+                self._finished = True
+            if self.samplewidth != self.source_samplewidth:
+                frames = dsp.lin2lin(frames, self.source_samplewidth, self.samplewidth)
+            if self.samplewidth == 1:
+                frames = dsp.bias(frames, 1, 128)
+            self._buffer += frames
+        if size < 0:
+            size = len(self._buffer)
+        result = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return result
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.source.close()
+        super().close()
+
+
 class SampleStream:
     """
     Turns a wav reader that produces frames, into a stream of Sample objects.
     You can add filters to the stream that process the Sample objects coming trough.
+    Every Sample has buffer_size frames (except the last one), also when a frames filter
+    produces a different number of frames than it gets (such as the StreamingResampler).
     """
     def __init__(self, wav_reader, buffer_size):
         self.source = wav_reader
@@ -176,10 +288,16 @@ class SampleStream:
         self.buffer_size = buffer_size
         self.filters = []
         self.frames_filters = []
+        self._pending = bytearray()     # filtered frames that haven't been returned yet
+        self._ended = False
 
     def add_frames_filter(self, filter):
         filter.set_params(self.buffer_size, self.samplerate, self.samplewidth, self.nchannels)
         self.frames_filters.append(filter)
+        # a frames filter can change the sample rate, width or channels of the stream (such as the StreamingResampler)
+        self.samplerate = getattr(filter, "output_samplerate", self.samplerate)
+        self.samplewidth = getattr(filter, "output_samplewidth", self.samplewidth)
+        self.nchannels = getattr(filter, "output_nchannels", self.nchannels)
 
     def add_filter(self, filter):
         filter.set_params(self.buffer_size, self.samplerate, self.samplewidth, self.nchannels)
@@ -189,9 +307,18 @@ class SampleStream:
         return self
 
     def __next__(self):
-        frames = self.source.readframes(self.buffer_size)
-        for filter in self.frames_filters:
-            frames = filter(frames)
+        chunk_size = self.buffer_size * self.samplewidth * self.nchannels
+        while len(self._pending) < chunk_size and not self._ended:
+            source_frames = self.source.readframes(self.buffer_size)
+            frames = source_frames
+            for filter in self.frames_filters:
+                frames = filter(frames)
+            # a filter can hold back frames (while it is priming), the stream only ends when the source has ended
+            # and the filters have nothing left to flush
+            self._ended = not source_frames and not frames
+            self._pending += frames
+        frames = bytes(self._pending[:chunk_size])
+        del self._pending[:chunk_size]
         if not frames:
             return None
         sample = Sample.from_raw_frames(frames, self.samplewidth, self.samplerate, self.nchannels)
@@ -203,6 +330,28 @@ class SampleStream:
         self.source.close()
 
 
+class SampleChunkStream:
+    """
+    Turns a Sample into a stream of chunk Samples (see Sample.iter_chunks), just like a SampleStream does
+    for a wav reader. The chunks are views on the data of the sample so nothing is copied.
+    """
+    def __init__(self, sample, buffer_size):
+        self.samplewidth = sample.samplewidth
+        self.samplerate = sample.samplerate
+        self.nchannels = sample.nchannels
+        self.buffer_size = buffer_size
+        self.chunks = sample.iter_chunks(buffer_size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks, None)
+
+    def close(self):
+        self.chunks.close()
+
+
 class EndlessFramesFilter:
     """
     Turns a frame stream into an endless frame stream by adding silence frames at the end until closed.
@@ -214,6 +363,96 @@ class EndlessFramesFilter:
         return frames if frames else self.silence_frame
 
 
+class StreamingResampler:
+    """
+    Frames filter that converts the stream to another sample rate, in-process (requires numpy).
+    The filter state is kept between the frame buffers, so there are no clicks at the buffer boundaries.
+    The number of frames it returns varies (it returns none at all while the filter is still priming),
+    the SampleStream regroups them into buffers of the normal size. At the end of the stream
+    the remaining frames are flushed out.
+    """
+    def __init__(self, samplerate, quality="medium"):
+        if not Resampler:
+            raise RuntimeError("in-process resampling requires numpy")
+        self.output_samplerate = samplerate
+        self.quality = quality
+        self.resampler = None
+        self.flushed = False
+
+    def set_params(self, buffer_size, samplerate, samplewidth, nchannels):
+        self.resampler = Resampler(samplerate, self.output_samplerate, samplewidth, nchannels, self.quality)
+        self.flushed = False
+
+    def __call__(self, frames):
+        if frames:
+            return self.resampler.process(frames)
+        if self.flushed:
+            return b""
+        self.flushed = True
+        return self.resampler.flush()
+
+
+class SampleWidthFilter:
+    """
+    Frames filter that converts the stream to another sample width (such as packed 24 bit to 16 bit).
+    """
+    def __init__(self, samplewidth):
+        assert 1 <= samplewidth <= 4
+        self.output_samplewidth = samplewidth
+        self.samplewidth = None
+
+    def set_params(self, buffer_size, samplerate, samplewidth, nchannels):
+        self.samplewidth = samplewidth
+
+    def __call__(self, frames):
+        return dsp.lin2lin(frames, self.samplewidth, self.output_samplewidth)
+
+
+class RemixFilter:
+    """
+    Frames filter that mixes the channels of the stream with a channel matrix (see Sample.remix),
+    or converts it to the given number of channels.
+    """
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.output_nchannels = matrix if isinstance(matrix, int) else len(matrix)
+        self.samplewidth = self.nchannels = None
+
+    def set_params(self, buffer_size, samplerate, samplewidth, nchannels):
+        self.samplewidth = samplewidth
+        self.nchannels = nchannels
+        if isinstance(self.matrix, int):
+            self.matrix = Sample.channel_matrix(nchannels, self.matrix)
+
+    def __call__(self, frames):
+        return dsp.remix(frames, self.samplewidth, self.nchannels, self.matrix)
+
+
+class ConvolutionFilter:
+    """
+    Frames filter that convolves the stream with an impulse response (an array of gain factors), requires numpy.
+    Use convolver.reverb_kernel() to create one for a reverb. The tail is flushed out at the end of the stream.
+    """
+    def __init__(self, impulse_response):
+        if not Convolver:
+            raise RuntimeError("convolution requires numpy")
+        self.impulse_response = impulse_response
+        self.convolver = None
+        self.flushed = False
+
+    def set_params(self, buffer_size, samplerate, samplewidth, nchannels):
+        self.convolver = Convolver(self.impulse_response, samplewidth, nchannels)
+        self.flushed = False
+
+    def __call__(self, frames):
+        if frames:
+            return self.convolver.process(frames)
+        if self.flushed:
+            return b""
+        self.flushed = True
+        return self.convolver.flush()
+
+
 class VolumeFilter:
     def __init__(self, volume=1.0):
         self.volume = volume
@@ -248,6 +487,12 @@ class StreamMixer:
     def add_stream(self, stream, filters=None, endless=False, end_callback=None):
         ws = wave.open(stream, 'r')
         ss = SampleStream(ws, self.buffer_size)
+        if ss.samplerate != self.samplerate:
+            ss.add_frames_filter(StreamingResampler(self.samplerate))
+        if ss.samplewidth != self.samplewidth:
+            ss.add_frames_filter(SampleWidthFilter(self.samplewidth))
+        if ss.nchannels != self.nchannels:
+            ss.add_frames_filter(RemixFilter(self.nchannels))
         if endless:
             ss.add_frames_filter(EndlessFramesFilter())
         for f in (filters or []):
@@ -260,7 +505,8 @@ class StreamMixer:
         self.sample_streams.remove(stream)
         if stream in self.wrapped_streams:
             wrapped_stream, end_callback = self.wrapped_streams.pop(stream)
-            wrapped_stream.close()
+            if wrapped_stream:
+                wrapped_stream.close()
             if end_callback is not None:
                 end_callback()
 
@@ -268,10 +514,9 @@ class StreamMixer:
         assert sample.samplewidth == self.samplewidth
         assert sample.samplerate == self.samplerate
         assert sample.nchannels == self.nchannels
-        stream = io.BytesIO()
-        sample.write_wav(stream)
-        stream.seek(0, io.SEEK_SET)
-        self.add_stream(stream, end_callback=end_callback)
+        ss = SampleChunkStream(sample, self.buffer_size)
+        self.sample_streams.append(ss)
+        self.wrapped_streams[ss] = (None, end_callback)
 
     def __enter__(self):
         return self
@@ -289,16 +534,22 @@ class StreamMixer:
         Yields tuple(timestamp, Sample) that represent the mixed audio streams.
         """
         while True:
-            mixed_sample = Sample.from_raw_frames(b"", self.samplewidth, self.samplerate, self.nchannels)
-            for sample_stream in self.sample_streams:
+            samples = []
+            for sample_stream in list(self.sample_streams):
                 try:
                     sample = next(sample_stream)
                 except (os.error, ValueError):
                     # Problem reading from stream. Assume stream closed.
                     sample = None
                 if sample:
-                    mixed_sample.mix(sample)
+                    samples.append(sample)
                 else:
                     self.remove_stream(sample_stream)
+            if len(samples) == 1:
+                mixed_sample = samples[0]    # nothing to mix, avoid copying the frames
+            else:
+                mixed_sample = Sample.from_raw_frames(b"", self.samplewidth, self.samplerate, self.nchannels)
+                for sample in samples:
+                    mixed_sample.mix(sample)
             yield self.timestamp, mixed_sample
             self.timestamp += mixed_sample.duration
@@ -10,6 +10,10 @@ import itertools
 import random
 import math
 from .sample import Sample
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __all__ = ["key_num", "key_freq", "note_freq", "octave_notes", "note_alias", "major_chords", "major_chord_keys",
@@ -113,13 +117,16 @@ class WaveSynth:
     Waveform sample synthesizer. Can generate various wave forms based on mathematic functions:
     sine, square (perfect or with harmonics), triangle, sawtooth (perfect or with harmonics),
     variable harmonics, white noise.  It also supports an optional LFO for Frequency Modulation.
-    The resulting waveform sample data is in integer 16 or 32 bits format.
+    The resulting waveform sample data is in integer 16, 24 or 32 bits format.
+    With intern_samples, the resulting samples are locked and interned (see Sample.intern),
+    so generating the same waveform more than once yields the same Sample (sharing the sample data).
     """
-    def __init__(self, samplerate=Sample.norm_samplerate, samplewidth=Sample.norm_samplewidth):
-        if samplewidth not in (2, 4):
-            raise ValueError("only sample widths 2 and 4 are supported")
+    def __init__(self, samplerate=Sample.norm_samplerate, samplewidth=Sample.norm_samplewidth, intern_samples=False):
+        if samplewidth not in (2, 3, 4):
+            raise ValueError("only sample widths 2, 3 and 4 are supported")
         self.samplerate = samplerate
         self.samplewidth = samplewidth
+        self.intern_samples = intern_samples
 
     def sine(self, frequency, duration, amplitude=0.9999, phase=0.0, bias=0.0, fm_lfo=None):
         """Simple sine wave. Optional FM using a supplied LFO."""
@@ -314,7 +321,8 @@ class WaveSynth:
     def __render_sample(self, duration, wave):
         wave = iter(wave)
         samples = Sample.get_array(self.samplewidth, [int(next(wave)) for _ in range(int(duration*self.samplerate))])
-        return Sample.from_array(samples, self.samplerate, 1)
+        sample = Sample.from_array(samples, self.samplerate, 1, self.samplewidth)
+        return sample.intern() if self.intern_samples else sample
 
 
 class Oscillator:
@@ -337,6 +345,45 @@ class Oscillator:
     def generator(self):
         yield from self._source
 
+    def blocks(self, blocksize):
+        """
+        Generator that produces the oscillator's values in blocks of the given size.
+        Oscillators that have a vectorized implementation yield numpy arrays,
+        otherwise the blocks are lists of values taken from the regular generator.
+        """
+        values = self.generator()
+        while True:
+            yield list(itertools.islice(values, blocksize))
+
+    def _vectorized_blocks(self, blocksize, frequency, phase, waveform):
+        """Block generator for simple periodic waveforms (without FM), computed with numpy."""
+        increment = frequency/self._samplerate
+        steps = numpy.arange(blocksize)*increment
+        cycles = phase
+        while True:
+            yield waveform(cycles+steps)*self.amplitude+self.bias
+            cycles = (cycles+blocksize*increment) % 1.0
+
+
+def _sine_wave(cycles):
+    return numpy.sin(2.0*math.pi*cycles)
+
+
+def _triangle_wave(cycles):
+    return 4.0*(numpy.abs((cycles+0.75) % 1.0 - 0.5)-0.25)
+
+
+def _square_wave(cycles):
+    return numpy.where(numpy.floor(cycles*2.0) % 2, -1.0, 1.0)
+
+
+def _sawtooth_wave(cycles):
+    return 2.0*(cycles-numpy.floor(0.5+cycles))
+
+
+def _pulse_wave(pulsewidth):
+    return lambda cycles: numpy.where(cycles % 1.0 < pulsewidth, 1.0, -1.0)
+
 
 class EnvelopeFilter(Oscillator):
     """
@@ -523,8 +570,14 @@ class Sine(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
         self.fm = iter(fm_lfo or itertools.repeat(0.0))
+        self._fm_lfo = fm_lfo
         self._phase = phase
 
+    def blocks(self, blocksize):
+        if numpy is None or self._fm_lfo:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self.frequency, self._phase, _sine_wave)
+
     def generator(self):
         phase_correction = self._phase*2*math.pi
         freq_previous = self.frequency
@@ -547,8 +600,14 @@ class Triangle(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
         self.fm = iter(fm_lfo or itertools.repeat(0.0))
+        self._fm_lfo = fm_lfo
         self._phase = phase
 
+    def blocks(self, blocksize):
+        if numpy is None or self._fm_lfo:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self.frequency, self._phase, _triangle_wave)
+
     def generator(self):
         phase_correction = self._phase
         freq_previous = self.frequency
@@ -572,8 +631,14 @@ class Square(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
         self.fm = iter(fm_lfo or itertools.repeat(0.0))
+        self._fm_lfo = fm_lfo
         self._phase = phase
 
+    def blocks(self, blocksize):
+        if numpy is None or self._fm_lfo:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self.frequency, self._phase, _square_wave)
+
     def generator(self):
         phase_correction = self._phase
         freq_previous = self.frequency
@@ -596,8 +661,14 @@ class Sawtooth(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
         self.fm = iter(fm_lfo or itertools.repeat(0.0))
+        self._fm_lfo = fm_lfo
         self._phase = phase
 
+    def blocks(self, blocksize):
+        if numpy is None or self._fm_lfo:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self.frequency, self._phase, _sawtooth_wave)
+
     def generator(self):
         increment = 1.0/self._samplerate
         freq_previous = self.frequency
@@ -628,8 +699,15 @@ class Pulse(Oscillator):
         self.pulsewidth = pulsewidth
         self.fm = iter(fm_lfo or itertools.repeat(0.0))
         self.pwm = iter(pwm_lfo or itertools.repeat(pulsewidth))
+        self._fm_lfo = fm_lfo
+        self._pwm_lfo = pwm_lfo
         self._phase = phase
 
+    def blocks(self, blocksize):
+        if numpy is None or self._fm_lfo or self._pwm_lfo:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self.frequency, self._phase, _pulse_wave(self.pulsewidth))
+
     def generator(self):
         epsilon = sys.float_info.epsilon
         increment = 1.0/self._samplerate
@@ -747,6 +825,11 @@ class FastSine(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
 
+    def blocks(self, blocksize):
+        if numpy is None:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self._frequency, self._phase, _sine_wave)
+
     def generator(self):
         rate = self._samplerate/self._frequency
         increment = 2.0*math.pi/rate
@@ -766,6 +849,11 @@ class FastTriangle(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
 
+    def blocks(self, blocksize):
+        if numpy is None:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self._frequency, self._phase, _triangle_wave)
+
     def generator(self):
         freq = self._frequency
         t = self._phase/freq
@@ -785,6 +873,11 @@ class FastSquare(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
 
+    def blocks(self, blocksize):
+        if numpy is None:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self._frequency, self._phase, _square_wave)
+
     def generator(self):
         freq = self._frequency
         t = self._phase/freq
@@ -803,6 +896,11 @@ class FastSawtooth(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
 
+    def blocks(self, blocksize):
+        if numpy is None:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self._frequency, self._phase, _sawtooth_wave)
+
     def generator(self):
         freq = self._frequency
         t = self._phase/freq
@@ -831,6 +929,11 @@ class FastPulse(Oscillator):
         self.amplitude = amplitude
         self.bias = bias
 
+    def blocks(self, blocksize):
+        if numpy is None or self._pwm:
+            return super().blocks(blocksize)
+        return self._vectorized_blocks(blocksize, self._frequency, self._phase, _pulse_wave(self._pulsewidth))
+
     def generator(self):
         if self._pwm:
             # optimized loop without FM, but with PWM
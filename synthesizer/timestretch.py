@@ -0,0 +1,74 @@
+"""
+Changing the tempo of sample data without changing its pitch, using WSOLA
+(waveform similarity based overlap-add). Overlapping windowed segments of the input
+are laid out at a different spacing, where every segment is shifted a bit so that it
+continues the waveform of the previous one as closely as possible (found by FFT cross-correlation).
+Requires numpy.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import functools
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+from .resampler import frames_to_array, array_to_frames
+
+
+__all__ = ["time_stretch", "segment_size"]
+
+
+segment_seconds = 0.03     # duration of the overlapping segments, short enough to keep drum hits sharp
+
+
+def segment_size(samplerate):
+    """Returns the (even) number of frames in a segment for the given sample rate."""
+    return max(64, int(samplerate * segment_seconds) // 2 * 2)
+
+
+@functools.lru_cache(maxsize=16)
+def _window(size):
+    # periodic hann window: at 50% overlap, the windows add up to exactly 1
+    window = 0.5 - 0.5 * numpy.cos(2 * numpy.pi * numpy.arange(size) / size)
+    window.flags.writeable = False
+    return window.reshape(-1, 1)
+
+
+def time_stretch(frames, samplewidth, nchannels, samplerate, factor):
+    """
+    Stretches the raw sample frames in time by the given factor (2.0 = twice as long, so half the tempo),
+    without changing the pitch. Returns the new frames, there are round(input frames * factor) of them.
+    """
+    assert factor > 0
+    values = frames_to_array(frames, samplewidth, nchannels)
+    length = int(round(len(values) * factor))
+    if not length:
+        return b""
+    size = segment_size(samplerate)
+    hop = size // 2                     # synthesis hop: the spacing of the segments in the output
+    analysis_hop = hop / factor         # the spacing of the segments in the input
+    tolerance = hop // 2                # maximum shift of a segment to find the best waveform match
+    segments = (length + hop) // hop + 1
+    # pad the input so that every segment (and its search area) lies within it, the padding in front
+    # makes the first segment's fade-in fall before the start of the output
+    front = hop + tolerance
+    back = size + 2*tolerance + hop + int(segments*analysis_hop) - len(values)
+    padded = numpy.concatenate((numpy.zeros((front, nchannels)), values, numpy.zeros((max(back, 0), nchannels))))
+    mono = padded.sum(axis=1)
+    # find the best start position of every segment
+    nominal = numpy.round(numpy.arange(segments) * analysis_hop).astype(int) + tolerance
+    starts = nominal.copy()
+    fft_size = 1 << int(2*size + 2*tolerance - 1).bit_length()
+    for k in range(1, segments):
+        # the segment should continue where the previous segment naturally goes on
+        template = mono[starts[k-1]+hop:starts[k-1]+hop+size]
+        region = mono[nominal[k]-tolerance:nominal[k]+tolerance+size]
+        correlation = numpy.fft.irfft(numpy.fft.rfft(region, fft_size) * numpy.conj(numpy.fft.rfft(template, fft_size)),
+                                      fft_size)[:2*tolerance+1]
+        starts[k] = nominal[k] - tolerance + int(numpy.argmax(correlation))
+    # overlap-add all windowed segments in one go: every output block of 'hop' frames
+    # is the second half of one segment plus the first half of the next
+    windows = sliding_window_view(padded, size, axis=0)[starts].transpose(0, 2, 1) * _window(size)
+    output = windows[:, :hop].copy()
+    output[1:] += windows[:-1, hop:]
+    output = output.reshape(-1, nchannels)[hop:hop+length]
+    return array_to_frames(output, samplewidth)
@@ -0,0 +1,132 @@
+"""
+Buffered asynchronous writing of streamed sample data to a WAV, RF64 or raw PCM file.
+The sample frames are collected in large blocks that are written by a background thread,
+so the code that produces the frames (such as a mixer) doesn't have to wait for the disk.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: MIT open-source.
+"""
+
+import os
+import struct
+import queue
+import threading
+
+
+__all__ = ["BufferedWaveWriter"]
+
+
+class BufferedWaveWriter:
+    """
+    Writes sample frames to a file via a bounded queue and a background thread, in large aligned blocks.
+    Format is 'wav', 'rf64' or 'raw' (headerless PCM). If you don't give a format, it's 'raw' for
+    files with a .raw or .pcm extension, and 'wav' otherwise. A wav file that gets larger than 4 Gb
+    is written as RF64 automatically. The header is written once, when the writer is closed
+    (so the file must be seekable, unless it's raw). The header is padded to header_size,
+    so the sample data starts at an aligned position in the file.
+    """
+    block_size = 1 << 20    # the frames are written in (multiples of) blocks of this many bytes
+    queue_size = 16         # maximum number of pending writes before write() has to wait for the disk
+    header_size = 4096      # size of the (padded) wav header
+
+    def __init__(self, file_or_filename, samplewidth, samplerate, nchannels, format=None):
+        if format is None:
+            extension = os.path.splitext(file_or_filename)[1].lower() if isinstance(file_or_filename, str) else ""
+            format = "raw" if extension in (".raw", ".pcm") else "wav"
+        if format not in ("wav", "rf64", "raw"):
+            raise ValueError("format must be one of: wav, rf64, raw")
+        self.format = format
+        self.samplewidth = samplewidth
+        self.samplerate = samplerate
+        self.nchannels = nchannels
+        if isinstance(file_or_filename, str):
+            self._file = open(file_or_filename, "wb")
+            self._owns_file = True
+        else:
+            self._file = file_or_filename
+            self._owns_file = False
+        if format != "raw":
+            if not self._file.seekable():
+                raise ValueError("writing a wav file requires a seekable file")
+            self._start = self._file.tell()
+            self._file.write(bytes(self.header_size))     # placeholder, the actual header is written at the end
+        self.datasize = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._thread = threading.Thread(target=self._writer, name="wave-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, xtype, value, traceback):
+        self.close()
+
+    def write(self, frames):
+        """Queue the frames to be written. Blocks if the writer thread is too far behind."""
+        if self._error:
+            raise IOError("error writing wave data") from self._error
+        if not (isinstance(frames, bytes) or (isinstance(frames, memoryview) and isinstance(frames.obj, bytes))):
+            frames = bytes(frames)    # the caller could still modify the data while it is in the queue
+        if frames:
+            self.datasize += len(frames)
+            self._queue.put(frames)
+
+    def close(self):
+        """Writes the remaining frames and the header, and closes the file (if it was opened by the writer)."""
+        if not self._thread:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        try:
+            if self._error:
+                raise IOError("error writing wave data") from self._error
+            if self.format != "raw":
+                end = self._file.tell()
+                self._file.seek(self._start)
+                self._file.write(self._header())
+                self._file.seek(end)
+            self._file.flush()
+        finally:
+            if self._owns_file:
+                self._file.close()
+
+    def _writer(self):
+        buffer = bytearray()
+        frames = b""
+        try:
+            while frames is not None:
+                frames = self._queue.get()
+                if frames is None:
+                    if self.format != "raw" and len(buffer) % 2:
+                        buffer += b"\0"    # wav chunks have an even size
+                    self._file.write(buffer)
+                else:
+                    buffer += frames
+                    if len(buffer) >= self.block_size:
+                        size = len(buffer) // self.block_size * self.block_size
+                        self._file.write(memoryview(buffer)[:size])
+                        del buffer[:size]
+        except Exception as x:
+            self._error = x
+            # keep draining the queue so that write() won't block forever
+            while frames is not None:
+                frames = self._queue.get()
+
+    def _header(self):
+        frame_size = self.samplewidth * self.nchannels
+        fmt_chunk = struct.pack("<4sIHHIIHH", b"fmt ", 16, 1, self.nchannels, self.samplerate,
+                                self.samplerate * frame_size, frame_size, 8 * self.samplewidth)
+        riff_size = self.header_size - 8 + self.datasize + self.datasize % 2
+        if self.format == "rf64" or riff_size > 0xffffffff:
+            # RF64: the real sizes are in the ds64 chunk, the 32 bits size fields are set to -1
+            ds64_chunk = struct.pack("<4sIQQQI", b"ds64", 28, riff_size, self.datasize, self.datasize // frame_size, 0)
+            header = struct.pack("<4sI4s", b"RF64", 0xffffffff, b"WAVE") + ds64_chunk
+            data_size = 0xffffffff
+        else:
+            header = struct.pack("<4sI4s", b"RIFF", riff_size, b"WAVE")
+            data_size = self.datasize
+        # the remaining space before the fmt and data chunks is filled with a junk chunk
+        junk_size = self.header_size - len(header) - len(fmt_chunk) - 8 - 8
+        header += struct.pack("<4sI", b"JUNK", junk_size) + bytes(junk_size)
+        return header + fmt_chunk + struct.pack("<4sI", b"data", data_size)
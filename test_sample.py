@@ -0,0 +1,91 @@
+"""
+Regression tests for Sample: the lazy mode (a chain of operations is executed in a single pass),
+and the down-mixing and panning of samples with more than two channels.
+Run with pytest, or directly with Python.
+"""
+
+import os
+import array
+import pytest
+import synthesizer.sample
+from synthesizer.sample import Sample
+
+sample_file = os.path.join(os.path.dirname(__file__), "samples", "Drop the bass now.wav")     # 48 kHz mono
+
+
+class PassCounter:
+    # counts how often the recorded operations of a lazy sample are executed (a pass over the data)
+    def __init__(self):
+        self.passes = 0
+        self.execute = synthesizer.sample._LazyPlan.execute
+
+    def __enter__(self):
+        def counting_execute(plan):
+            self.passes += 1
+            return self.execute(plan)
+        synthesizer.sample._LazyPlan.execute = counting_execute
+        return self
+
+    def __exit__(self, *args):
+        synthesizer.sample._LazyPlan.execute = self.execute
+
+
+def test_fades_are_fused():
+    with PassCounter() as counter:
+        sample = Sample(wave_file=sample_file).lazy()
+        sample.fadein(0.5).fadeout(0.5)
+        assert counter.passes == 0
+        frames = bytes(sample.view_frame_data())
+    assert counter.passes == 1
+    expected = Sample(wave_file=sample_file).fadein(0.5).fadeout(0.5)
+    assert frames == bytes(expected.view_frame_data())
+
+
+def test_load_and_prepare_chain_is_one_pass():
+    with PassCounter() as counter:
+        sample = Sample(wave_file=sample_file).lazy().normalize().fadein(0.1).fadeout(0.5).make_32bit()
+        assert counter.passes == 0
+        assert abs(sample.duration - Sample(wave_file=sample_file).duration) < 0.001
+        frames = bytes(sample.view_frame_data())
+    assert counter.passes == 1
+    expected = Sample(wave_file=sample_file).normalize().fadein(0.1).fadeout(0.5).make_32bit()
+    assert len(frames) == len(expected.view_frame_data())
+
+
+def test_clip_then_normalize_is_one_pass():
+    with PassCounter() as counter:
+        sample = Sample(wave_file=sample_file).lazy().clip(0.2, 1.0).normalize()
+        frames = bytes(sample.view_frame_data())
+    assert counter.passes == 1
+    assert len(frames) == len(Sample(wave_file=sample_file).clip(0.2, 1.0).normalize().view_frame_data())
+
+
+def test_downmix_is_balanced_and_does_not_clip():
+    for nchannels in range(3, 9):
+        left, right = Sample.channel_matrix(nchannels, 2)
+        assert sum(left) == pytest.approx(sum(right))
+        assert sum(left) <= 1.0 + 1e-9
+    # 5.1 (L R C LFE Ls Rs): the LFE channel is left out, the centre goes equally to both sides
+    left, right = Sample.channel_matrix(6, 2)
+    assert left[3] == right[3] == 0.0
+    assert left[2] == right[2] > 0.0
+    loud = array.array("h", [20000] * 6 * 100).tobytes()
+    sample = Sample.from_raw_frames(loud, 2, 44100, 6).remix(2)
+    assert max(array.array("h", bytes(sample.view_frame_data()))) <= 20000     # not clipped at 32767
+
+
+def test_pan_rejects_more_than_two_channels():
+    sample = Sample.from_raw_frames(bytes(2 * 6 * 100), 2, 44100, 6)
+    with pytest.raises(ValueError, match="mono or stereo"):
+        sample.pan(lfo=[0.5] * 100)
+    with pytest.raises(ValueError, match="mono or stereo"):
+        sample.pan(0.3)
+
+
+if __name__ == "__main__":
+    test_fades_are_fused()
+    test_load_and_prepare_chain_is_one_pass()
+    test_clip_then_normalize_is_one_pass()
+    test_downmix_is_balanced_and_does_not_clip()
+    test_pan_rejects_more_than_two_channels()
+    print("ok")
@@ -0,0 +1,60 @@
+"""
+Regression tests for the on-disk cache of normalized instrument samples.
+Run with pytest, or directly with Python.
+"""
+
+import os
+import gc
+import tempfile
+import synthesizer.samplecache
+from synthesizer.sample import Sample
+from synthesizer.samplecache import SampleCache
+
+sample_file = os.path.join(os.path.dirname(__file__), "samples", "Drop the bass now.wav")     # 48 kHz mono
+
+
+def test_cache_key_includes_resampling_method():
+    cache = SampleCache(tempfile.mkdtemp())
+    original_quality, original_numpy = Sample.resample_quality, synthesizer.samplecache.numpy
+    try:
+        names = set()
+        for quality in ("low", "medium", "high"):
+            Sample.resample_quality = quality
+            names.add(cache.cache_filename(sample_file))
+        synthesizer.samplecache.numpy = None      # without numpy, the linear resampler is used
+        names.add(cache.cache_filename(sample_file))
+    finally:
+        Sample.resample_quality, synthesizer.samplecache.numpy = original_quality, original_numpy
+    assert len(names) == 4
+
+
+def test_cached_sample_is_the_same():
+    cache = SampleCache(tempfile.mkdtemp())
+    loaded = bytes(cache.load(sample_file).view_frame_data())
+    cached = cache.load(sample_file)
+    assert bytes(cached.view_frame_data()) == loaded
+
+
+def mapped_files(directory):
+    with open("/proc/self/maps") as maps:
+        return sum(1 for line in maps if directory in line)
+
+
+def test_memory_map_is_released_with_the_sample():
+    if not os.path.exists("/proc/self/maps"):
+        return
+    directory = tempfile.mkdtemp()
+    cache = SampleCache(directory)
+    cache.load(sample_file)
+    sample = cache.load(sample_file)
+    assert mapped_files(directory) == 1
+    del sample
+    gc.collect()
+    assert mapped_files(directory) == 0
+
+
+if __name__ == "__main__":
+    test_cache_key_includes_resampling_method()
+    test_cached_sample_is_the_same()
+    test_memory_map_is_released_with_the_sample()
+    print("ok")
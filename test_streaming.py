@@ -0,0 +1,70 @@
+"""
+Regression tests for the stream mixer with streams that are resampled in-process.
+Run with pytest, or directly with Python.
+"""
+
+import io
+import math
+import wave
+import array
+import pytest
+from synthesizer.sample import Sample
+from synthesizer.streaming import StreamMixer, Resampler
+
+
+def wav_stream(samplerate, seconds, amplitude=8000, frequency=440):
+    # a 16 bit stereo wav file in memory, with a sine tone
+    frames = array.array("h")
+    for i in range(int(samplerate * seconds)):
+        value = int(amplitude * math.sin(2 * math.pi * frequency * i / samplerate))
+        frames.extend((value, value))
+    stream = io.BytesIO()
+    with wave.open(stream, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(samplerate)
+        w.writeframes(frames.tobytes())
+    stream.seek(0)
+    return stream
+
+
+def mix(mixer):
+    chunks = []
+    for _, sample in mixer:
+        if not mixer.sample_streams:
+            break
+        chunks.append(sample)
+    return chunks
+
+
+@pytest.mark.skipif(not Resampler, reason="in-process resampling requires numpy")
+def test_resampled_stream_mixed_without_gaps():
+    mixer = StreamMixer([], samplewidth=2, samplerate=44100, nchannels=2)
+    mixer.add_stream(wav_stream(48000, 2.0))
+    mixer.add_stream(wav_stream(44100, 2.0, amplitude=0))    # native rate, silent
+    chunks = mix(mixer)
+    # all buffers have the normal size, except the last one
+    assert all(len(chunk) == StreamMixer.buffer_size for chunk in chunks[:-1])
+    frames = array.array("h", b"".join(bytes(chunk.view_frame_data()) for chunk in chunks))
+    left = frames[::2]
+    # the sine tone must not contain runs of silence (a few zero crossings are fine)
+    longest_zeros = zeros = 0
+    for value in left[100:-2000]:
+        zeros = zeros + 1 if value == 0 else 0
+        longest_zeros = max(longest_zeros, zeros)
+    assert longest_zeros < 3
+    assert abs(len(left) - 2.0 * 44100) < 100
+
+
+@pytest.mark.skipif(not Resampler, reason="in-process resampling requires numpy")
+def test_short_resampled_stream_is_not_dropped():
+    mixer = StreamMixer([], samplewidth=2, samplerate=44100, nchannels=2)
+    mixer.add_stream(wav_stream(48000, 0.0002))     # shorter than the resampler's filter
+    chunks = mix(mixer)
+    assert sum(len(chunk) for chunk in chunks) == pytest.approx(0.0002 * 44100, abs=2)
+
+
+if __name__ == "__main__":
+    test_resampled_stream_mixed_without_gaps()
+    test_short_resampled_stream_is_not_dropped()
+    print("ok")
@@ -14,12 +14,17 @@ from synthesizer.sample import Sample
 from synthesizer.playback import Output
 
 
-def main(track_file, outputfile=None, interactive=False):
+def main(track_file, outputfile=None, interactive=False, workers=0):
     discard_unused = not interactive
     if interactive:
         repl = Repl(discard_unused_instruments=discard_unused)
         repl.do_load(track_file)
         repl.cmdloop("Interactive Samplebox session. Type 'help' for help on commands.")
+    elif workers:
+        # mix to a wav file, rendered by multiple processes
+        song = Song()
+        song.read(track_file, discard_unused_instruments=discard_unused)
+        song.mix(outputfile, workers=workers)
     else:
         song = Song()
         song.read(track_file, discard_unused_instruments=discard_unused)
@@ -27,8 +32,7 @@ def main(track_file, outputfile=None, interactive=False):
             if out.supports_streaming:
                 # mix and stream output in real time
                 print("Mixing and streaming to speakers...")
-                out.play_samples(song.mix_generator())
-                print("\r                          ")
+                out.play_source(song.sequencer())
                 out.wait_all_played()
             else:
                 # output can't stream, fallback on mixing everything to a wav
@@ -41,27 +45,26 @@ def main(track_file, outputfile=None, interactive=False):
 
 
 def usage():
-    print("Arguments:  [-i] trackfile.ini")
+    print("Arguments:  [-i | -w workers] trackfile.ini")
     print("   -i = start interactive editing mode")
+    print("   -w = mix to trackfile.wav (instead of playing it), using this number of worker processes")
     raise SystemExit(1)
 
 if __name__ == "__main__":
-    if len(sys.argv) not in (2, 3):
-        usage()
-    track_file = None
+    args = sys.argv[1:]
     interactive = False
-    if len(sys.argv) == 2:
-        if sys.argv[1] == "-i":
-            usage()  # need a trackfile as well to at least initialize the samples
-        else:
-            track_file = sys.argv[1]
-    elif len(sys.argv) == 3:
-        if sys.argv[1] != "-i":
-            usage()
+    workers = 0
+    if args[:1] == ["-i"]:
         interactive = True
-        track_file = sys.argv[2]
+        args = args[1:]
+    elif args[:1] == ["-w"] and len(args) > 1 and args[1].isdigit():
+        workers = int(args[1])
+        args = args[2:]
+    if len(args) != 1 or args[0].startswith("-"):
+        usage()     # need a trackfile as well to at least initialize the samples
+    track_file = args[0]
     if interactive:
         main(track_file, interactive=True)
     else:
         output_file = os.path.splitext(track_file)[0]+".wav"
-        main(track_file, output_file)
+        main(track_file, output_file, workers=workers)